@@ -0,0 +1,21 @@
+import random
+
+
+class Backoff:
+    # 指数退避，每次在 [delay/2, delay] 之间随机取值，避免多台打印机或多个连接同时重试
+    def __init__(self, initial=1, maximum=30, factor=2):
+        self.initial = initial
+        self.maximum = maximum
+        self.factor = factor
+        self.delay = initial
+        self.attempts = 0
+
+    def next(self):
+        delay = self.delay
+        self.delay = min(self.maximum, self.delay * self.factor)
+        self.attempts += 1
+        return random.uniform(delay / 2, delay)
+
+    def reset(self):
+        self.delay = self.initial
+        self.attempts = 0
@@ -0,0 +1,200 @@
+"""离线性能测试：用 pty 模拟屏幕、用本地服务模拟 Moonraker，不需要打印机。
+
+    venv/bin/python3 benchmark/bench.py                       # 全部场景
+    venv/bin/python3 benchmark/bench.py browse --files 10000  # 指定场景
+    venv/bin/python3 benchmark/bench.py steady --replay status.jsonl --speed 4
+
+CPU 为整个进程的占用，包含模拟的屏幕和 Moonraker。
+"""
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+import importlib.util
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import metrics
+from fakescreen import FakeScreen
+from fakemoonraker import FakeMoonraker, make_files, make_thumbnail, initial_status, printing_stream, heating_stream, load_recording
+
+logger = logging.getLogger('Benchmark')
+logger.setLevel(logging.INFO)
+
+
+def load_app(data_dir=None):
+    # neptune-screen.py 的文件名不能直接 import；data_dir 代替 ~/printer_data/neptune-screen，不影响本机的状态缓存
+    spec = importlib.util.spec_from_file_location('neptune_screen', ROOT / 'neptune-screen.py')
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    if data_dir is not None:
+        module.KlipperScreen.STATE_CACHE = str(Path(data_dir) / 'state.json')
+        module.KlipperScreen.FIRMWARE_RECORD = str(Path(data_dir) / 'firmware.json')
+    logging.getLogger('KlipperScreen').setLevel(logging.WARNING)
+    logging.getLogger('TJC').setLevel(logging.WARNING)
+    logging.getLogger('Thumbnail').setLevel(logging.WARNING)
+    logging.getLogger('FileIndex').setLevel(logging.WARNING)
+    return module
+
+
+def summarize(samples):
+    histogram = metrics.Histogram(max(len(samples), 1))
+    for value in samples:
+        histogram.record(value)
+    return histogram.summary()
+
+
+class Bench:
+    def __init__(self, args, files=(), status=None, thumbnail=None):
+        self.args = args
+        self.moonraker = FakeMoonraker(files, status, thumbnail, args.delay)
+        self.screen = FakeScreen(args.baudrate)
+        self.cache = tempfile.TemporaryDirectory()
+        self.app = None
+
+    async def __aenter__(self):
+        await self.moonraker.start()
+        await self.screen.start()
+        config = {
+            'Serial': self.screen.port,
+            'Baudrate': self.args.baudrate,
+            'Moonraker': '127.0.0.1',
+            'FanStartTemp': 100,
+            'FanStopTemp': 90,
+            'ThumbnailCacheDir': self.cache.name,
+        }
+        if self.args.capture:
+            config['CaptureFile'] = self.args.capture
+        self.app = load_app(self.cache.name).KlipperScreen(config)
+        self.app.client.port = self.moonraker.port
+        printing = self.moonraker.status['print_stats']['state'] in ('printing', 'paused')
+        ready = self.screen.expect('page printpause' if printing else 'page main')
+        await self.app.start()
+        await asyncio.wait_for(ready, 10)
+        # 等待开机后的后台任务（缩略图预生成等）完成
+        await asyncio.sleep(self.args.settle)
+        self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        if self.app is not None:
+            await self.app.stop()
+        self.screen.close()
+        await self.moonraker.close()
+        self.cache.cleanup()
+
+    def start(self):
+        self.wall = time.monotonic()
+        self.cpu = time.process_time()
+        self.rx_bytes = self.screen.rx_bytes
+        self.rx_commands = self.screen.rx_commands
+        self.notify_bytes = self.moonraker.notify_bytes
+
+    def result(self, operations, samples=None, keys=()):
+        elapsed = time.monotonic() - self.wall
+        snapshot = self.app.metrics.snapshot()
+        result = {
+            'elapsed': round(elapsed, 3),
+            'ops_per_sec': round(operations / elapsed, 1),
+            'serial_bytes_per_sec': round((self.screen.rx_bytes - self.rx_bytes) / elapsed, 1),
+            'serial_commands_per_sec': round((self.screen.rx_commands - self.rx_commands) / elapsed, 1),
+            'notify_bytes_per_sec': round((self.moonraker.notify_bytes - self.notify_bytes) / elapsed, 1),
+            'cpu': round((time.process_time() - self.cpu) / elapsed, 3),
+        }
+        if samples is not None:
+            result['latency'] = summarize(samples)
+        for key in keys:
+            if key in snapshot['latency']:
+                result[key] = snapshot['latency'][key]
+        return result
+
+
+async def replay(bench, records):
+    count = await bench.moonraker.replay(records, bench.args.speed)
+    # 等最后一次状态刷新到屏幕
+    await asyncio.sleep(1.0)
+    return bench.result(count, keys=('notify_to_serial',))
+
+
+async def steady(args):
+    # 打印中的状态通知：温度波动、进度、Z 高度
+    records = load_recording(args.replay) if args.replay else printing_stream(args.duration)
+    async with Bench(args, make_files(10), initial_status('printing', 'file00000.gcode')) as bench:
+        return await replay(bench, records)
+
+
+async def heatup(args):
+    # 加热过程中高频的温度通知
+    async with Bench(args, make_files(10)) as bench:
+        return await replay(bench, heating_stream(args.duration))
+
+
+async def browse(args):
+    # 在大量文件中翻页
+    async with Bench(args, make_files(args.files, 20)) as bench:
+        pages = min(args.pages, (args.files + 4) // 5)
+        samples = []
+        for page in range(pages):
+            done = bench.screen.expect('click load_list,1')
+            start = bench.screen.touch(f'fs ls {page} 5 /')
+            samples.append(await asyncio.wait_for(done, 10) - start)
+        return bench.result(pages, samples, ('request.fs', 'call.server.files.list'))
+
+
+async def preview(args):
+    # 预览未缓存的缩略图：下载、生成 jpeg、上传到屏幕
+    offset = 100
+    async with Bench(args, make_files(args.previews + offset), thumbnail=make_thumbnail()) as bench:
+        samples = []
+        for i in range(args.previews):
+            done = bench.screen.expect('name.aph=0')
+            start = bench.screen.touch(f'fs preview /file{i + offset:05d}.gcode')
+            samples.append(await asyncio.wait_for(done, 30) - start)
+        return bench.result(args.previews, samples, ('request.fs', 'thumbnail.fetch', 'thumbnail.render', 'thumbnail.upload'))
+
+
+SCENARIOS = {
+    'steady': steady,
+    'heatup': heatup,
+    'browse': browse,
+    'preview': preview,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description='NeptuneScreen offline benchmark')
+    parser.add_argument('scenarios', nargs='*', help=f'scenarios to run: {", ".join(SCENARIOS)} (default: all)')
+    parser.add_argument('--baudrate', type=int, default=512000, help='simulated serial baud rate')
+    parser.add_argument('--duration', type=float, default=10, help='seconds of generated notifications')
+    parser.add_argument('--replay', help='recorded notifications (json lines) for the steady scenario')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed multiplier')
+    parser.add_argument('--files', type=int, default=10000, help='number of files for the browse scenario')
+    parser.add_argument('--pages', type=int, default=200, help='number of pages to browse')
+    parser.add_argument('--previews', type=int, default=20, help='number of thumbnail previews')
+    parser.add_argument('--delay', type=float, default=0, help='simulated Moonraker response time')
+    parser.add_argument('--settle', type=float, default=1.0, help='seconds to wait after boot')
+    parser.add_argument('--json', help='write results to this file')
+    parser.add_argument('--capture', help='record serial and Moonraker traffic to this file (see replay.py)')
+    args = parser.parse_args()
+    for name in args.scenarios:
+        if name not in SCENARIOS:
+            parser.error(f'unknown scenario: {name}')
+
+    logging.basicConfig(format="[%(asctime)s][%(name)s][%(levelname)s]%(message)s")
+    results = {}
+    for name in args.scenarios or SCENARIOS:
+        logger.info(f'Running {name}...')
+        results[name] = asyncio.run(SCENARIOS[name](args))
+        print(name, json.dumps(results[name], indent=2))
+    if args.json:
+        with open(args.json, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,230 @@
+import io
+import json
+import time
+import random
+import asyncio
+import logging
+from aiohttp import web, WSMsgType
+
+logger = logging.getLogger('FakeMoonraker')
+logger.setLevel(logging.INFO)
+
+FILE_SIZE = 10 * 1024 * 1024
+
+
+def make_files(count, dirs=0):
+    # count 个文件放在根目录，另外 dirs 个子目录各放 10 个文件
+    now = time.time()
+    files = [{'path': f'file{i:05d}.gcode', 'modified': now - i * 60, 'size': FILE_SIZE, 'permissions': 'rw'}
+             for i in range(count)]
+    for d in range(dirs):
+        files += [{'path': f'dir{d:03d}/file{i:02d}.gcode', 'modified': now - i, 'size': FILE_SIZE, 'permissions': 'rw'}
+                  for i in range(10)]
+    return files
+
+
+def make_thumbnail(size=300):
+    from PIL import Image, ImageDraw
+    im = Image.new('RGBA', (size, size), (40, 40, 40, 255))
+    draw = ImageDraw.Draw(im)
+    for i in range(0, size, 10):
+        draw.line((0, i, size, size - i), fill=(i % 255, 128, 255 - i % 255, 255), width=3)
+    out = io.BytesIO()
+    im.save(out, format='png')
+    return out.getvalue()
+
+
+def initial_status(print_state='standby', filename=''):
+    return {
+        'print_stats': {'state': print_state, 'filename': filename, 'print_duration': 0},
+        'heater_bed': {'temperature': 25.0, 'target': 0},
+        'extruder': {'temperature': 25.0, 'target': 0},
+        'toolhead': {'homed_axes': 'xyz'},
+        'fan': {'speed': 0},
+        'gcode_move': {'speed_factor': 1.0, 'gcode_position': [0, 0, 0, 0]},
+        'output_pin LED_pin': {'value': 0},
+        'bed_mesh': {'probed_matrix': [[0.0] * 6] * 6, 'profile_name': 'default', 'profiles': {'default': {}}},
+        'virtual_sdcard': {'file_position': 0},
+        'filament_switch_sensor filament_sensor': {'filament_detected': True},
+    }
+
+
+def printing_stream(duration, rate=4):
+    # 打印过程中的状态通知：(时间, 方法, 参数)，默认与 Moonraker 一样每 250ms 一次
+    records = []
+    for i in range(int(duration * rate)):
+        t = i / rate
+        status = {
+            'extruder': {'temperature': 210 + random.uniform(-0.5, 0.5)},
+            'heater_bed': {'temperature': 60 + random.uniform(-0.2, 0.2)},
+            'print_stats': {'print_duration': t},
+            'virtual_sdcard': {'file_position': 1000 + int(t * 20000)},
+            'gcode_move': {'gcode_position': [100, 100, 0.2 + int(t / 5) * 0.2, 0]},
+        }
+        records.append((t, 'notify_status_update', [status, t]))
+    return records
+
+
+def heating_stream(duration, rate=50):
+    # 加热过程中高频的温度变化
+    records = [(0, 'notify_status_update', [{'extruder': {'target': 210}, 'heater_bed': {'target': 60}}, 0])]
+    for i in range(1, int(duration * rate)):
+        t = i / rate
+        status = {
+            'extruder': {'temperature': min(210, 25 + t * 20) + random.uniform(-0.3, 0.3)},
+            'heater_bed': {'temperature': min(60, 25 + t * 4) + random.uniform(-0.1, 0.1)},
+        }
+        records.append((t, 'notify_status_update', [status, t]))
+    return records
+
+
+def load_recording(path):
+    # 每行一个 json：{"time": 秒, "method": "notify_status_update", "params": [...]}
+    records = []
+    with open(path, 'r') as fp:
+        for line in fp:
+            if line.strip():
+                item = json.loads(line)
+                records.append((item['time'], item['method'], item['params']))
+    start = records[0][0] if records else 0
+    return [(t - start, method, params) for t, method, params in records]
+
+
+class FakeMoonraker:
+    # Moonraker 的 websocket JSON-RPC 和文件下载接口
+    def __init__(self, files=(), status=None, thumbnail=None, delay=0):
+        self.files = list(files)
+        # 不包含文件的目录，如 'empty/sub'
+        self.empty_dirs = []
+        self.status = status or initial_status()
+        self.thumbnail = thumbnail
+        # 每个请求的处理延时，模拟 Moonraker 的响应时间
+        self.delay = delay
+        self.sockets = set()
+        self.calls = {}
+        # 与 Moonraker 一样只推送订阅的对象，None 表示全部
+        self.subscribed = None
+        self.notify_bytes = 0
+        self.runner = None
+        self.port = None
+        self.methods = {
+            'server.websocket.id': lambda params: {'websocket_id': 1},
+            'server.connection.identify': lambda params: {'connection_id': 1},
+            'server.info': lambda params: {'klippy_state': 'ready', 'klippy_connected': True},
+            'printer.info': lambda params: {'state': 'ready', 'software_version': 'v0.12.0-0-bench'},
+            'machine.system_info': lambda params: {'system_info': {'network': {
+                'eth0': {'ip_addresses': [{'family': 'ipv4', 'address': '127.0.0.1'}]}}}},
+            'server.files.list': lambda params: self.files,
+            'server.files.get_directory': self.get_directory,
+            'server.files.metadata': self.metadata,
+            'server.files.thumbnails': self.thumbnails,
+            'printer.objects.subscribe': self.subscribe,
+            'printer.objects.query': lambda params: {'eventtime': time.time(), 'status': self.status},
+            'printer.gcode.script': lambda params: 'ok',
+        }
+
+    def subscribe(self, params):
+        self.subscribed = set(params.get('objects') or ())
+        status = {name: fields for name, fields in self.status.items() if name in self.subscribed}
+        return {'eventtime': time.time(), 'status': status}
+
+    def get_directory(self, params):
+        # 只列出一层，与 Moonraker 相同
+        directory = params.get('path', 'gcodes').partition('/')[2].strip('/')
+        prefix = directory + '/' if directory else ''
+        dirs, files = set(), []
+        for path in [item['path'] for item in self.files] + [path + '/' for path in self.empty_dirs]:
+            if not path.startswith(prefix):
+                continue
+            name, sep, _ = path[len(prefix):].partition('/')
+            if sep:
+                dirs.add(name)
+            elif name:
+                files.append({'filename': name})
+        return {'dirs': [{'dirname': name} for name in sorted(dirs)], 'files': files}
+
+    def metadata(self, params):
+        return {
+            'filename': params.get('filename'),
+            'modified': time.time(),
+            'size': FILE_SIZE,
+            'estimated_time': 3600,
+            'gcode_start_byte': 1000,
+            'gcode_end_byte': FILE_SIZE,
+        }
+
+    def thumbnails(self, params):
+        if self.thumbnail is None:
+            return []
+        name = params['filename'].rsplit('.', maxsplit=1)[0]
+        return [{'width': 300, 'height': 300, 'size': len(self.thumbnail), 'thumbnail_path': f'.thumbs/{name}-300x300.png'}]
+
+    async def start(self, host='127.0.0.1', port=0):
+        app = web.Application()
+        app.router.add_get('/websocket', self._websocket)
+        app.router.add_get('/server/files/{path:.*}', self._file)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+        return self.port
+
+    async def close(self):
+        for ws in list(self.sockets):
+            await ws.close()
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+    async def _file(self, request):
+        if self.thumbnail is None:
+            raise web.HTTPNotFound()
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        return web.Response(body=self.thumbnail, content_type='image/png')
+
+    async def _websocket(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        self.sockets.add(ws)
+        try:
+            async for msg in ws:
+                if msg.type != WSMsgType.TEXT:
+                    continue
+                request = json.loads(msg.data)
+                asyncio.create_task(self._call(ws, request))
+        finally:
+            self.sockets.discard(ws)
+        return ws
+
+    async def _call(self, ws, request):
+        method = request.get('method')
+        self.calls[method] = self.calls.get(method, 0) + 1
+        if self.delay:
+            await asyncio.sleep(self.delay)
+        handler = self.methods.get(method)
+        result = handler(request.get('params') or {}) if handler else {}
+        if 'id' in request and not ws.closed:
+            await ws.send_str(json.dumps({'jsonrpc': '2.0', 'result': result, 'id': request['id']}))
+
+    async def notify(self, method, params):
+        if method == 'notify_status_update' and self.subscribed is not None:
+            status = {name: fields for name, fields in params[0].items() if name in self.subscribed}
+            if not status:
+                return
+            params = [status] + list(params[1:])
+        data = json.dumps({'jsonrpc': '2.0', 'method': method, 'params': params})
+        for ws in list(self.sockets):
+            if not ws.closed:
+                self.notify_bytes += len(data)
+                await ws.send_str(data)
+
+    async def replay(self, records, speed=1.0):
+        # 按记录的时间间隔发送通知，speed > 1 时加速
+        start = time.monotonic()
+        for t, method, params in records:
+            delay = start + t / speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            await self.notify(method, params)
+        return len(records)
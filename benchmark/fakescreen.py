@@ -0,0 +1,173 @@
+import os
+import pty
+import tty
+import time
+import struct
+import asyncio
+import logging
+
+logger = logging.getLogger('FakeScreen')
+logger.setLevel(logging.INFO)
+
+TERMINATOR = b'\xff\xff\xff'
+COMOK = b'comok 1,30614-0,TJC4832T135_011R,52,61488,D264B8204F0E1828,16777216' + TERMINATOR
+# twfile 每块数据的包头：3a a1 bb 44 7f ff fe + struct('<BHH', 0, 块序号, 块大小)
+TWFILE_HEADER_SIZE = 12
+
+
+class FakeDisplay:
+    # 模拟 TJC 屏幕的协议：解析 ff ff ff 结尾的命令，应答 connect/twfile/whmi-wri，
+    # 并可以发送 5a a5 格式的触摸请求；_write 由子类实现
+
+    # 屏幕收到 whmi-wri 后约 270ms 回复 0x05
+    FIRMWARE_ACK_DELAY = 0.27
+
+    def __init__(self, baudrate=512000, ack_delay=0.001):
+        self.baudrate = baudrate
+        self.ack_delay = ack_delay
+        self.buffer = bytearray()
+        # 'cmd'、'twfile'、'firmware'
+        self.mode = 'cmd'
+        self.remaining = 0
+        self.chunk_size = 0
+        self.page = None
+        # 控件 -> 最后一次赋值
+        self.controls = {}
+        # 命令 -> [future]，收到该命令时设置结果为收到的时间
+        self.waiters = {}
+        # 收到 'page boot' 后自动发送 boot 请求，模拟屏幕开机
+        self.auto_boot = True
+        self.rx_bytes = 0
+        self.rx_commands = 0
+        self.files = 0
+        self.firmware_bytes = 0
+
+    def touch(self, request):
+        # 发送屏幕请求，返回发送时间
+        payload = request.encode()
+        self._write(b'\x5a\xa5' + bytes([len(payload)]) + payload)
+        return time.monotonic()
+
+    def expect(self, command):
+        future = asyncio.get_running_loop().create_future()
+        self.waiters.setdefault(command, []).append(future)
+        return future
+
+    def _write(self, data):
+        raise NotImplementedError
+
+    def reply(self, data, delay=None):
+        loop = asyncio.get_running_loop()
+        loop.call_later(self.ack_delay if delay is None else delay, self._write, data)
+
+    def feed(self, data):
+        self.buffer.extend(data)
+        while self.buffer:
+            if self.mode == 'cmd':
+                end = self.buffer.find(TERMINATOR)
+                if end == -1:
+                    break
+                command = bytes(self.buffer[:end])
+                del self.buffer[:end + 3]
+                self.handle_command(command.decode(errors='replace'))
+            elif self.mode == 'twfile':
+                if len(self.buffer) < TWFILE_HEADER_SIZE:
+                    break
+                _, _, size = struct.unpack('<BHH', self.buffer[7:TWFILE_HEADER_SIZE])
+                if len(self.buffer) < TWFILE_HEADER_SIZE + size:
+                    break
+                del self.buffer[:TWFILE_HEADER_SIZE + size]
+                self.remaining -= size
+                if self.remaining <= 0:
+                    self.mode = 'cmd'
+                    self.files += 1
+                    self.reply(b'\xfd')
+                else:
+                    self.reply(b'\x05')
+            elif self.mode == 'firmware':
+                size = min(self.chunk_size, self.remaining)
+                if len(self.buffer) < size:
+                    break
+                del self.buffer[:size]
+                self.remaining -= size
+                self.firmware_bytes += size
+                if self.remaining <= 0:
+                    self.mode = 'cmd'
+                self.reply(b'\x05')
+
+    def handle_command(self, command):
+        self.rx_commands += 1
+        if command == 'connect':
+            self.reply(COMOK)
+        elif command.startswith('twfile '):
+            self.remaining = int(command.rsplit(',', maxsplit=1)[-1])
+            self.mode = 'twfile'
+            self.reply(b'\xfe' + TERMINATOR)
+        elif command.startswith('whmi-wri'):
+            size, baudrate, _ = command.split(' ', maxsplit=1)[1].split(',')
+            self.remaining = int(size)
+            self.chunk_size = 4096
+            self.baudrate = int(baudrate)
+            self.mode = 'firmware'
+            self.reply(b'\x05', self.FIRMWARE_ACK_DELAY)
+        elif command.startswith('page '):
+            self.page = command[5:]
+            if self.page == 'boot' and self.auto_boot:
+                asyncio.get_running_loop().call_later(0.05, self.touch, 'boot')
+        elif '=' in command:
+            name, _, value = command.partition('=')
+            self.controls[name] = value
+        now = time.monotonic()
+        for future in self.waiters.pop(command, ()):
+            if not future.done():
+                future.set_result(now)
+
+
+class FakeScreen(FakeDisplay):
+    # 通过 pty 模拟屏幕，按波特率限制读取速度
+    READ_SIZE = 256
+
+    def __init__(self, baudrate=512000, ack_delay=0.001):
+        super().__init__(baudrate, ack_delay)
+        self.master, self.slave = pty.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.port = os.ttyname(self.slave)
+        self.task = None
+
+    async def start(self):
+        self.task = asyncio.create_task(self._read_loop())
+
+    def close(self):
+        if self.task is not None:
+            self.task.cancel()
+        for fd in (self.master, self.slave):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def _write(self, data):
+        try:
+            os.write(self.master, data)
+        except OSError as e:
+            logger.error(f'Write failed: {e}')
+
+    async def _read_loop(self):
+        loop = asyncio.get_running_loop()
+        readable = asyncio.Event()
+        loop.add_reader(self.master, readable.set)
+        try:
+            while True:
+                await readable.wait()
+                readable.clear()
+                try:
+                    data = os.read(self.master, self.READ_SIZE)
+                except BlockingIOError:
+                    continue
+                self.rx_bytes += len(data)
+                self.feed(data)
+                # 按波特率限速，模拟串口传输时间，发送方的缓冲区会因此积压
+                await asyncio.sleep(len(data) * 10 / self.baudrate)
+        finally:
+            loop.remove_reader(self.master)
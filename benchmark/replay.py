@@ -0,0 +1,197 @@
+"""回放 CaptureFile 记录的串口数据和 Moonraker 通知，不需要连接打印机和屏幕。
+
+    venv/bin/python3 benchmark/replay.py ~/printer_data/logs/neptune-screen.cap
+    venv/bin/python3 benchmark/replay.py neptune-screen.cap --speed 10 --profile replay.prof
+
+收到的屏幕请求和通知按记录的时间间隔送入 KlipperScreen，Moonraker 调用返回记录的结果；
+发送的串口数据由模拟的屏幕处理（应答 twfile 等），记录中的应答不回放。
+"""
+import sys
+import json
+import time
+import asyncio
+import logging
+import argparse
+import tempfile
+import cProfile
+import pstats
+from pathlib import Path
+from collections import deque
+
+ROOT = Path(__file__).resolve().parent.parent
+sys.path.insert(0, str(ROOT))
+
+import tjc
+import capture
+from bench import load_app
+from fakescreen import FakeDisplay
+from fakemoonraker import make_thumbnail
+
+logger = logging.getLogger('Replay')
+logger.setLevel(logging.INFO)
+
+
+class SerialSink(FakeDisplay):
+    # 代替串口的 transport 和 serial，发送的数据交给模拟的屏幕，应答直接送回 protocol
+    def __init__(self, protocol):
+        super().__init__()
+        self.protocol = protocol
+        self.auto_boot = False
+        self.rts = False
+        self.serial = self
+        self.bytes = 0
+        self.writes = 0
+
+    def write(self, data):
+        self.bytes += len(data)
+        self.writes += 1
+        self.feed(data)
+
+    def _write(self, data):
+        self.protocol.data_received(data)
+
+    def get_write_buffer_size(self):
+        return 0
+
+    def set_write_buffer_limits(self, high=None, low=None):
+        pass
+
+    def close(self):
+        self.protocol.connection_lost(None)
+
+
+class Replayer:
+    def __init__(self, records, speed=1.0):
+        self.records = records
+        self.speed = speed
+        # 方法 -> 按顺序记录的结果
+        self.results = {}
+        for _, kind, data in records:
+            if kind == capture.CALL:
+                self.results.setdefault(data['method'], deque()).append(data)
+        self.thumbnail = None
+        self.counts = {}
+        self.tx_bytes = 0
+        self.rx_buffer = bytearray()
+
+    async def call(self, method, **kwargs):
+        results = self.results.get(method)
+        if not results:
+            logger.debug(f'No recorded result: {method}')
+            return {}
+        item = results.popleft() if len(results) > 1 else results[0]
+        await asyncio.sleep(item.get('elapsed', 0) / self.speed)
+        return item['result']
+
+    async def fetch_file(self, path):
+        # 记录中没有文件内容，用生成的图片代替
+        if self.thumbnail is None:
+            self.thumbnail = make_thumbnail()
+        return self.thumbnail
+
+    def frames(self, data):
+        # 只回放 5a a5 格式的屏幕请求，应答由 SerialSink 根据实际发送的数据产生
+        buf = self.rx_buffer
+        buf.extend(data)
+        while True:
+            start = buf.find(tjc.AsyncSerialScreenProtocol.HEADER)
+            if start == -1:
+                del buf[:len(buf) - 1 if buf.endswith(b'\x5a') else len(buf)]
+                return
+            del buf[:start]
+            if len(buf) < 3 or len(buf) < 3 + buf[2]:
+                return
+            end = 3 + buf[2]
+            yield bytes(buf[:end])
+            del buf[:end]
+
+    async def run(self, app):
+        tasks = set()
+        start = time.monotonic()
+        begin = self.records[0][0] if self.records else 0
+        for timestamp, kind, data in self.records:
+            delay = start + (timestamp - begin) / self.speed - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            name = capture.KIND_NAMES.get(kind, str(kind))
+            self.counts[name] = self.counts.get(name, 0) + 1
+            if kind == capture.NOTIFICATION:
+                # 与 MoonrakerClient 一样，每个通知在单独的任务中处理
+                task = asyncio.create_task(app.on_notification(data['method'], data['params']))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            elif kind == capture.SERIAL_RX:
+                for frame in self.frames(data):
+                    app.screen.protocol.data_received(frame)
+            elif kind == capture.SERIAL_TX:
+                self.tx_bytes += len(data)
+        if tasks:
+            await asyncio.wait(tasks)
+        return time.monotonic() - start
+
+
+async def replay(args, records):
+    cache = tempfile.TemporaryDirectory()
+    config = {
+        'Serial': None,
+        'Baudrate': 512000,
+        'Moonraker': '127.0.0.1',
+        'FanStartTemp': 100,
+        'FanStopTemp': 90,
+        'ThumbnailCacheDir': cache.name,
+    }
+    app = load_app(cache.name).KlipperScreen(config)
+    replayer = Replayer(records, args.speed)
+    app.call = replayer.call
+    app.fetch_file = replayer.fetch_file
+    protocol = tjc.AsyncSerialScreenProtocol()
+    sink = SerialSink(protocol)
+    protocol.connection_made(sink)
+    app.screen.attach(sink, protocol)
+    app.screen.set_request_handler(app.scheduler.submit)
+    app.thumbnail_worker.start()
+    app.render_task = asyncio.create_task(app.render_loop())
+
+    cpu = time.process_time()
+    elapsed = await replayer.run(app)
+    # 等最后的状态刷新到串口
+    await asyncio.sleep(1.0)
+    cpu = time.process_time() - cpu
+    result = {
+        'records': replayer.counts,
+        'elapsed': round(elapsed, 3),
+        'cpu': round(cpu / (elapsed + 1.0), 3),
+        'tx_bytes_recorded': replayer.tx_bytes,
+        'tx_bytes_replayed': sink.bytes,
+        'metrics': app.metrics.snapshot(),
+    }
+    await app.stop()
+    cache.cleanup()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay a NeptuneScreen capture')
+    parser.add_argument('capture', help='capture file, rotated files (.1, .2, ...) are replayed first')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed multiplier')
+    parser.add_argument('--profile', help='write cProfile stats to this file')
+    args = parser.parse_args()
+
+    logging.basicConfig(format="[%(asctime)s][%(name)s][%(levelname)s]%(message)s")
+    records = []
+    for path in capture.capture_files(args.capture):
+        records += capture.read_records(path)
+    logger.info(f'Loaded {len(records)} records')
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+    result = asyncio.run(replay(args, records))
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+        pstats.Stats(profiler).sort_stats('cumulative').print_stats(15)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,140 @@
+import json
+import time
+import struct
+import logging
+import threading
+from pathlib import Path
+from collections import deque
+
+logger = logging.getLogger('Capture')
+logger.setLevel(logging.INFO)
+
+MAGIC = b'NSCAP1\n'
+# 每条记录：时间戳(秒)、类型、数据长度，后面是数据
+RECORD = struct.Struct('<dBI')
+
+SERIAL_TX = 1
+SERIAL_RX = 2
+# json：{"method", "params"}
+NOTIFICATION = 3
+# json：{"method", "params", "result", "elapsed"}
+CALL = 4
+
+KIND_NAMES = {SERIAL_TX: 'tx', SERIAL_RX: 'rx', NOTIFICATION: 'notify', CALL: 'call'}
+
+
+class CaptureWriter:
+    # 记录先放到内存中的环形缓冲区，由后台线程写入文件；线程跟不上时丢弃最旧的记录
+    # 文件超过 max_size 后轮换为 path.1 ... path.N
+    def __init__(self, path, max_size=10*1024*1024, backups=3, buffer_records=10000, interval=0.5):
+        self.path = Path(path).expanduser()
+        self.max_size = max_size
+        self.backups = backups
+        self.interval = interval
+        self.records = deque(maxlen=buffer_records)
+        self.recorded = 0
+        self.dropped = 0
+        self.written = 0
+        self.fp = None
+        self.running = True
+        self.event = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='capture', daemon=True)
+        self.thread.start()
+
+    def record(self, kind, data):
+        if len(self.records) == self.records.maxlen:
+            self.dropped += 1
+        self.records.append((time.time(), kind, data))
+        self.recorded += 1
+
+    def record_json(self, kind, obj):
+        self.record(kind, json.dumps(obj, default=str))
+
+    def close(self):
+        self.running = False
+        self.event.set()
+        self.thread.join()
+
+    def _open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.fp = open(self.path, 'ab')
+        if self.fp.tell() == 0:
+            self.fp.write(MAGIC)
+
+    def _rotate(self):
+        self.fp.close()
+        self.fp = None
+        for i in range(self.backups - 1, 0, -1):
+            src = self.path.with_name(f'{self.path.name}.{i}')
+            if src.exists():
+                src.replace(self.path.with_name(f'{self.path.name}.{i + 1}'))
+        if self.backups > 0:
+            self.path.replace(self.path.with_name(f'{self.path.name}.1'))
+        else:
+            self.path.unlink()
+
+    def _run(self):
+        while self.running:
+            self.event.wait(self.interval)
+            self.event.clear()
+            try:
+                self._write()
+            except OSError as e:
+                logger.error(f'Write capture failed: {e}')
+                self.records.clear()
+        try:
+            self._write()
+        finally:
+            if self.fp is not None:
+                self.fp.close()
+
+    def _write(self):
+        if not self.records:
+            return
+        if self.fp is None:
+            self._open()
+        while self.records:
+            timestamp, kind, data = self.records.popleft()
+            if isinstance(data, str):
+                data = data.encode()
+            self.fp.write(RECORD.pack(timestamp, kind, len(data)))
+            self.fp.write(data)
+            self.written += 1
+            if self.fp.tell() > self.max_size:
+                self._rotate()
+                self._open()
+        self.fp.flush()
+
+    def stats(self):
+        return {
+            'recorded': self.recorded,
+            'written': self.written,
+            'dropped': self.dropped,
+            'buffered': len(self.records),
+        }
+
+
+def read_records(path):
+    # 返回 (时间戳, 类型, 数据)，json 类型的数据已解码
+    with open(path, 'rb') as fp:
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f'Not a capture file: {path}')
+        while True:
+            header = fp.read(RECORD.size)
+            if len(header) < RECORD.size:
+                break
+            timestamp, kind, size = RECORD.unpack(header)
+            data = fp.read(size)
+            if len(data) < size:
+                logger.warning(f'Truncated record at end of {path}')
+                break
+            if kind in (NOTIFICATION, CALL):
+                data = json.loads(data)
+            yield timestamp, kind, data
+
+
+def capture_files(path):
+    # 按时间顺序返回轮换的文件：path.N ... path.1, path
+    path = Path(path).expanduser()
+    backups = sorted(path.parent.glob(f'{path.name}.*'), key=lambda p: -int(p.suffix[1:]) if p.suffix[1:].isdigit() else 0)
+    return [p for p in backups if p.suffix[1:].isdigit()] + ([path] if path.exists() else [])
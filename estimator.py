@@ -0,0 +1,70 @@
+import math
+
+
+class PrintTimeEstimator:
+    # 剩余打印时间的流式估计，每次更新 O(1)：
+    # 切片软件的预计时间与平滑后的文件进度速率按进度加权，进度越大越相信实际速率；
+    # 时间以 print_duration 计（不包括加热和暂停），并按速度倍率折算为 100% 速度下的时间
+
+    # 进度速率的平滑时间常数（秒）
+    RATE_TAU = 120
+    # 计算一次进度速率的最小时间窗口（秒），print_duration 每 250ms 更新一次
+    RATE_WINDOW = 5
+    # 进度达到该值后只使用进度速率的估计
+    RATE_TRUST = 0.5
+    # 显示的分钟数的滞后（秒），估计值在分钟边界附近波动时不来回跳动
+    HYSTERESIS = 10
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self, estimated_time=None):
+        # estimated_time 为 server.files.metadata 中切片软件的预计时间（秒）
+        self.estimated_time = estimated_time or 0
+        # 100% 速度下每秒完成的进度
+        self.rate = None
+        # 折算为 100% 速度的已打印时间
+        self.work = 0.0
+        self.duration = None
+        self.window_work = 0.0
+        self.window_progress = 0.0
+        self.remaining = 0.0
+        self.shown = None
+
+    def update(self, progress, duration, speed):
+        # 返回显示的剩余时间（秒，整分钟）
+        speed = speed if speed > 0 else 1
+        if self.duration is None:
+            # 打印中途启动时没有历史数据，按开始以来的平均速率
+            self.work = duration * speed
+            if progress > 0 and self.work > 0:
+                self.rate = progress / self.work
+            self.window_work, self.window_progress = self.work, progress
+        elif duration > self.duration:
+            self.work += (duration - self.duration) * speed
+        self.duration = duration
+
+        elapsed = self.work - self.window_work
+        if elapsed >= self.RATE_WINDOW:
+            rate = max(progress - self.window_progress, 0) / elapsed
+            if self.rate is None:
+                self.rate = rate
+            else:
+                self.rate += (1 - math.exp(-elapsed / self.RATE_TAU)) * (rate - self.rate)
+            self.window_work, self.window_progress = self.work, progress
+
+        by_slicer = max(self.estimated_time - self.work, 0) if self.estimated_time else None
+        by_rate = (1 - progress) / self.rate if self.rate else None
+        if by_rate is None:
+            remaining = by_slicer or 0
+        elif by_slicer is None:
+            remaining = by_rate
+        else:
+            weight = min(progress / self.RATE_TRUST, 1)
+            remaining = weight * by_rate + (1 - weight) * by_slicer
+        self.remaining = max(remaining, 0) / speed
+
+        shown = self.shown
+        if shown is None or not (shown - 60 - self.HYSTERESIS <= self.remaining <= shown + self.HYSTERESIS):
+            self.shown = math.ceil(self.remaining / 60) * 60
+        return self.shown
@@ -0,0 +1,175 @@
+import os
+import logging
+
+logger = logging.getLogger('FileIndex')
+logger.setLevel(logging.INFO)
+
+GCODE_EXTS = ('.gcode', '.gco')
+
+
+def is_gcode(filename):
+    _, ext = os.path.splitext(filename)
+    return ext.lower() in GCODE_EXTS
+
+
+def split_path(path):
+    # 'a/b/c.gcode' -> ('/a/b', 'c.gcode')，与屏幕使用的目录格式一致
+    directory, _, name = path.strip('/').rpartition('/')
+    return '/' + directory, name
+
+
+def join_path(directory, name):
+    return f'{directory.rstrip("/")}/{name}'.lstrip('/')
+
+
+class FileIndex:
+    # gcodes 目录下所有 gcode 文件的内存索引，按目录缓存排好序的列表
+    SORT_KEYS = {
+        'newest': (lambda item: item['modified'], True),
+        'oldest': (lambda item: item['modified'], False),
+        'name': (lambda item: item['name'].lower(), False),
+        'size': (lambda item: item['size'], True),
+    }
+
+    def __init__(self, sort='newest'):
+        if sort not in self.SORT_KEYS:
+            logger.error(f'Invalid sort order: {sort}')
+            sort = 'newest'
+        self.sort = sort
+        self.loaded = False
+        self.clear()
+
+    def clear(self):
+        # 文件路径 -> {'name', 'type', 'modified', 'size'}
+        self.files = {}
+        # 目录 -> {'dirs': set(), 'files': set()}
+        self.dirs = {'/': {'dirs': set(), 'files': set()}}
+        # (目录, 排序方式) -> 列表
+        self.sorted = {}
+
+    def load(self, items, dirs=()):
+        # items 为 server.files.list 的结果，只包含文件；dirs 为其他方式得到的目录（包括空目录）
+        self.clear()
+        for directory in dirs:
+            if not self._hidden(directory):
+                self.add_dir('/' + directory.strip('/'))
+        for item in items:
+            self.add_file(item['path'], item['modified'], item['size'])
+        self.loaded = True
+        logger.info(f'Indexed {len(self.files)} files in {len(self.dirs)} directories')
+
+    def _hidden(self, path):
+        return any(part.startswith('.') for part in path.strip('/').split('/'))
+
+    def add_dir(self, directory):
+        if directory in self.dirs:
+            return
+        self.dirs[directory] = {'dirs': set(), 'files': set()}
+        parent, name = split_path(directory)
+        self.add_dir(parent)
+        self.dirs[parent]['dirs'].add(name)
+        self._changed(parent)
+
+    def add_file(self, path, modified, size):
+        if not is_gcode(path) or self._hidden(path):
+            return
+        directory, name = split_path(path)
+        if directory != '/':
+            self.add_dir(directory)
+        self.files[path] = {'name': name, 'type': 'file', 'modified': modified, 'size': size}
+        self.dirs[directory]['files'].add(name)
+        self._changed(directory)
+
+    def remove_file(self, path):
+        if self.files.pop(path, None) is None:
+            return
+        directory, name = split_path(path)
+        self.dirs[directory]['files'].discard(name)
+        self._changed(directory)
+
+    def remove_dir(self, directory):
+        if directory not in self.dirs or directory == '/':
+            return
+        prefix = directory.strip('/') + '/'
+        for path in [path for path in self.files if path.startswith(prefix)]:
+            del self.files[path]
+        for path in [path for path in self.dirs if path == directory or path.startswith(directory + '/')]:
+            del self.dirs[path]
+            self._changed(path)
+        parent, name = split_path(directory)
+        self.dirs[parent]['dirs'].discard(name)
+        self._changed(parent)
+
+    def move_dir(self, src, dst):
+        prefix = src.strip('/') + '/'
+        moved = [(path, item) for path, item in self.files.items() if path.startswith(prefix)]
+        self.remove_dir(src)
+        self.add_dir(dst)
+        for path, item in moved:
+            self.add_file(dst.strip('/') + '/' + path[len(prefix):], item['modified'], item['size'])
+
+    def _changed(self, directory):
+        for sort in self.SORT_KEYS:
+            self.sorted.pop((directory, sort), None)
+
+    def apply(self, action, item, source_item=None):
+        # 根据 notify_filelist_changed 增量更新索引，返回是否需要重新加载
+        if action == 'root_update':
+            return True
+        if item.get('root') != 'gcodes':
+            if source_item and source_item.get('root') == 'gcodes':
+                action = 'delete_dir' if action == 'move_dir' else 'delete_file'
+                item = source_item
+            else:
+                return False
+        path = item['path']
+        if source_item and source_item.get('root') != 'gcodes':
+            source_item = None
+        if action in ('create_file', 'modify_file'):
+            self.add_file(path, item['modified'], item['size'])
+        elif action == 'delete_file':
+            self.remove_file(path)
+        elif action == 'move_file':
+            if source_item:
+                self.remove_file(source_item['path'])
+            self.add_file(path, item['modified'], item['size'])
+        elif action == 'create_dir':
+            if not self._hidden(path):
+                self.add_dir('/' + path.strip('/'))
+        elif action == 'delete_dir':
+            self.remove_dir('/' + path.strip('/'))
+        elif action == 'move_dir':
+            if source_item:
+                self.move_dir('/' + source_item['path'].strip('/'), '/' + path.strip('/'))
+            elif not self._hidden(path):
+                # 从其他目录移入，不知道包含哪些文件，需要重新加载
+                return True
+        return False
+
+    def get(self, path):
+        return self.files.get(path)
+
+    def listing(self, directory, sort=None):
+        # 目录在前（按名称），文件按指定方式排序；结果缓存到目录发生变化
+        sort = sort or self.sort
+        key = (directory, sort)
+        result = self.sorted.get(key)
+        if result is None:
+            entry = self.dirs.get(directory)
+            if entry is None:
+                return []
+            sort_key, reverse = self.SORT_KEYS[sort]
+            dirs = [{'name': name, 'type': 'directory'} for name in sorted(entry['dirs'], key=str.lower)]
+            files = [self.files[join_path(directory, name)] for name in entry['files']]
+            files.sort(key=sort_key, reverse=reverse)
+            result = self.sorted[key] = dirs + files
+        return result
+
+    def page(self, directory, page, page_size, sort=None):
+        files = self.listing(directory, sort)
+        page_max = (len(files) + page_size - 1) // page_size - 1
+        return files[page*page_size:(page + 1)*page_size], page_max
+
+    def newest(self, count):
+        items = sorted(self.files.items(), key=lambda item: item[1]['modified'], reverse=True)
+        return [(path, item['modified']) for path, item in items[:count]]
@@ -0,0 +1,138 @@
+import json
+import math
+import time
+import asyncio
+import logging
+from pathlib import Path
+
+logger = logging.getLogger('Metrics')
+logger.setLevel(logging.INFO)
+
+
+class Histogram:
+    # 固定大小的环形缓冲区，只保留最近 size 个样本用于计算分位数
+    def __init__(self, size=1024):
+        self.samples = [0.0] * size
+        self.index = 0
+        self.count = 0
+        self.total = 0.0
+
+    def record(self, value):
+        self.samples[self.index] = value
+        self.index = (self.index + 1) % len(self.samples)
+        self.count += 1
+        self.total += value
+
+    def summary(self):
+        # 时间单位为毫秒；avg 为全部样本，分位数和最大值为缓冲区内的样本
+        window = sorted(self.samples[:min(self.count, len(self.samples))])
+        if not window:
+            return {'count': 0}
+
+        def percentile(p):
+            # nearest-rank：第 ceil(n*p) 个样本
+            return round(window[max(0, math.ceil(len(window) * p) - 1)] * 1000, 3)
+
+        return {
+            'count': self.count,
+            'avg': round(self.total / self.count * 1000, 3),
+            'p50': percentile(0.5),
+            'p90': percentile(0.9),
+            'p99': percentile(0.99),
+            'max': round(window[-1] * 1000, 3),
+        }
+
+
+class Metrics:
+    def __init__(self, size=1024):
+        self.size = size
+        self.histograms = {}
+        # 名称 -> stats() 函数，导出时一起输出（命令队列、请求调度、缩略图等）
+        self.sources = {}
+        self.started = time.time()
+
+    def record(self, name, value):
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(self.size)
+        histogram.record(value)
+
+    def observe(self, name, start):
+        # start 为 time.monotonic() 的返回值
+        self.record(name, time.monotonic() - start)
+
+    def add_source(self, name, stats):
+        self.sources[name] = stats
+
+    def snapshot(self):
+        result = {
+            'time': time.time(),
+            'uptime': time.time() - self.started,
+            'latency': {name: histogram.summary() for name, histogram in sorted(self.histograms.items())},
+        }
+        for name, stats in self.sources.items():
+            try:
+                result[name] = stats()
+            except Exception as e:
+                result[name] = {'error': repr(e)}
+        return result
+
+
+class MetricsGroup:
+    # 多台打印机的统计，按名称分组导出
+    def __init__(self):
+        self.members = {}
+
+    def add(self, name, metrics):
+        self.members[name] = metrics
+
+    def snapshot(self):
+        return {'time': time.time(), 'printers': {name: metrics.snapshot() for name, metrics in self.members.items()}}
+
+
+class MetricsExporter:
+    # 定期把统计写入 json 文件，或者通过 Unix socket 按需读取：
+    # socat - UNIX-CONNECT:/tmp/neptune-screen.sock
+    def __init__(self, metrics, path=None, socket=None, interval=10):
+        self.metrics = metrics
+        self.path = Path(path).expanduser() if path else None
+        self.socket = Path(socket).expanduser() if socket else None
+        self.interval = interval
+        self.task = None
+        self.server = None
+
+    async def start(self):
+        if self.socket is not None:
+            try:
+                self.socket.unlink(missing_ok=True)
+                self.server = await asyncio.start_unix_server(self._handle, path=str(self.socket))
+            except OSError as e:
+                logger.error(f'Metrics socket disabled: {e}')
+        if self.path is not None and self.task is None:
+            self.task = asyncio.create_task(self._dump_loop())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+
+    async def _handle(self, reader, writer):
+        try:
+            writer.write(json.dumps(self.metrics.snapshot()).encode() + b'\n')
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def _dump_loop(self):
+        tmp = self.path.with_name(self.path.name + '.tmp')
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.path.parent.mkdir(parents=True, exist_ok=True)
+                tmp.write_text(json.dumps(self.metrics.snapshot(), indent=2))
+                tmp.replace(self.path)
+            except OSError as e:
+                logger.error(f'Write metrics failed: {e}')
@@ -3,15 +3,21 @@ import os
 import time
 import json
 import asyncio
+import hashlib
 import logging
 from pathlib import Path
 from typing import Any
-from pprint import pprint
-import requests
-from PIL import Image
-from moonraker_api.const import *
+from concurrent.futures import ThreadPoolExecutor
 from moonraker_api import MoonrakerListener, MoonrakerClient
 import tjc
+import thumbnail
+import fileindex
+import printerstate
+import scheduler
+import metrics
+import capture
+import estimator
+from backoff import Backoff
 
 logging.basicConfig(format="[%(asctime)s][%(name)s][%(levelname)s]%(message)s")
 logging.getLogger('moonraker_api').setLevel(logging.FATAL)
@@ -20,78 +26,296 @@ logger = logging.getLogger('KlipperScreen')
 logger.setLevel(logging.INFO)
 
 
-class KlipperScreen(MoonrakerListener):
+def file_sha256(path, chunk_size=1024*1024):
+    # 分块计算，不把整个固件读入内存
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fp:
+        while chunk := fp.read(chunk_size):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class SharedResources:
+    # 缩略图线程池、缓存和 HTTP 连接池，多台打印机时共用
+    def __init__(self, config, printers=1):
+        self.config = config
+        self.printers = printers
+        self.thumbnails = thumbnail.ThumbnailCache(
+            config.get('ThumbnailCacheDir', '~/printer_data/neptune-screen/thumbnails'),
+            config.get('ThumbnailCacheSize', 20) * 1024 * 1024)
+        # Pillow 处理放到线程池中，避免阻塞事件循环
+        self.thumbnail_pool = ThreadPoolExecutor(max_workers=config.get('ThumbnailWorkers', 1), thread_name_prefix='thumbnail')
+        self.http = None
+
+    def get_http(self):
+        # 复用连接，缩略图等文件下载都走同一个连接池，每个 Moonraker 最多 4 个连接
+        if self.http is None:
+            import aiohttp
+            self.http = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=4 * self.printers, limit_per_host=4, keepalive_timeout=60),
+                timeout=aiohttp.ClientTimeout(total=self.config.get('HttpTimeout', 10), connect=3))
+        return self.http
+
+    async def close(self):
+        if self.http is not None:
+            await self.http.close()
+            self.http = None
+        self.thumbnail_pool.shutdown(wait=False)
+
 
-    def __init__(self, config):
+class KlipperScreen(MoonrakerListener):
+    THUMBNAIL_WARM_COUNT = 20
+    THUMBNAIL_WARM_DELAY = 3
+    FIRMWARE_RECORD = '~/printer_data/neptune-screen/firmware.json'
+    # 上次的打印机状态，开机时先显示，实时数据到达后再更新
+    STATE_CACHE = '~/printer_data/neptune-screen/state.json'
+    STATE_SAVE_INTERVAL = 300
+    BED_MESH_TIMEOUT = 2
+    # 更新后需要重新计算进度和剩余时间的状态
+    PROGRESS_SLOTS = {'file_position', 'print_duration', 'print_speed'}
+
+    def __init__(self, config, shared=None):
         self.config = config
+        # 多打印机模式下的名称，用于区分缓存文件和统计
+        self.name = config.get('Name')
+        self.owns_shared = shared is None
+        self.shared = shared or SharedResources(config)
         self.has_connected = False
-        self.screen = tjc.AsyncTJCScreen()
-        self.client = MoonrakerClient(self, self.config['Moonraker'])
+        # 已经从 Moonraker 获取过完整状态，之后的重连只做增量同步
+        self.synced = False
+        self.ws_closed = asyncio.Event()
+        self.serial_task = None
+        self.ws_task = None
+        # 串口重新打开时 Moonraker 未连接，连接后需要重新开机
+        self.boot_pending = False
+        self.connections = {'serial': 0, 'moonraker': 0, 'resync': 0}
+        self.screen = tjc.AsyncTJCScreen(self.config.get('FrameInterval', 0.02), self.data_path(tjc.SCREEN_STATE_FILE))
+        self.client = MoonrakerClient(self, self.config['Moonraker'], self.config.get('MoonrakerPort', 7125))
         self.ip = ''
         self.version = ''
-        self.fs = {}
+        self.files = fileindex.FileIndex(self.config.get('FileSort', 'newest'))
+        self.thumbnails = self.shared.thumbnails
+        if self.name:
+            self.thumbnails = thumbnail.CacheNamespace(self.thumbnails, self.name)
+        self.thumbnail_pool = self.shared.thumbnail_pool
+        self.thumbnail_worker = thumbnail.ThumbnailWorker(
+            self.thumbnails, self._render_thumbnail, workers=self.config.get('ThumbnailWorkers', 1))
+        self.metrics = metrics.Metrics()
+        self.metrics_exporter = metrics.MetricsExporter(
+            self.metrics, self.config.get('MetricsFile'), self.config.get('MetricsSocket'), self.config.get('MetricsInterval', 10))
+        self.capture = None
+        if self.config.get('CaptureFile'):
+            self.capture = capture.CaptureWriter(
+                self.config['CaptureFile'], self.config.get('CaptureSize', 10) * 1024 * 1024, self.config.get('CaptureFiles', 3))
+            self.screen.capture = self.capture
+            self.metrics.add_source('capture', self.capture.stats)
+        self.scheduler = scheduler.RequestScheduler(self.on_screen_request, self.config.get('MaxConcurrentRequests', 4), self.metrics)
+        self.prefetch_handle = None
         self.cpu_fan_state = None
-        self.extruder_temp = 0
-        self.extruder_target_temp = 0
-        self.bed_temp = 0
-        self.bed_target_temp = 0
-        self.print_speed = 1
+        self.state = printerstate.PrinterState()
+        self.renderer = printerstate.Renderer(self.state, self.config.get('RefreshInterval'))
+        self.screen.on_page_changed = self.on_page_changed
+        self.screen.metrics = self.metrics
+        self.screen.queue.on_flush = self.on_screen_flush
+        self.metrics.add_source('serial', self.screen.stats)
+        self.metrics.add_source('scheduler', self.scheduler.stats)
+        self.metrics.add_source('thumbnail', self.thumbnail_worker.stats)
+        self.metrics.add_source('connections', lambda: dict(self.connections))
+        self.metrics.add_source('screen', lambda: dict(self.screen.info))
+        # 最早一条尚未显示的状态通知的时间，以及已经渲染、等待写入串口的通知时间
+        self.notify_time = None
+        self.render_notify_time = None
+        self.render_task = None
         self.print_progress = 0
-        self.print_duration = 0
-        self.print_state = ''
-        self.filename = None
-        self.led_state = 0
-        self.fan_speed = 0
-        self.z_value = 0
-        self.homed_axes = ''
-        self.bed_mesh_profiles = None
-        self.bed_mesh_profile_name = None
-        self.bed_mesh_probed_matrix = None
+        self.estimator = estimator.PrintTimeEstimator()
         self.current_file = None
-        self.file_position = 0
-        self.filament_detected = False
+        self.firmware_task = None
+        self.stopping = False
+        self.cached_state = self.load_state_cache()
+        self.state_saved = None
+        # 状态名 -> [future]，该状态更新时设置结果
+        self.state_waiters = {}
+        # 当前页面和已订阅的对象，订阅随页面和打印状态变化，见 printerstate.SUBSCRIBE_WHEN
+        self.page = None
+        self.subscribed = None
+        self.subscribe_lock = asyncio.Lock()
+        self.subscribe_task = None
 
     async def start(self) -> None:
         logger.info('Start NeptuneScreen...')
-        try:
-            await self.connect()
-        except:
-            pass
+        self.thumbnail_worker.start()
+        await self.metrics_exporter.start()
+        self.render_task = asyncio.create_task(self.render_loop())
+        # 串口和 Moonraker 分别维护连接，一边断开重连不影响另一边
+        self.serial_task = asyncio.create_task(self.serial_loop())
+        self.ws_task = asyncio.create_task(self.ws_loop())
+
+    async def stop(self):
+        self.stopping = True
+        for task in (self.serial_task, self.ws_task):
+            if task is not None:
+                task.cancel()
+        await self.client.disconnect()
+        if self.client.session is not None:
+            await self.client.session.close()
+        for task in (self.render_task, self.firmware_task):
+            if task is not None:
+                task.cancel()
+        self.thumbnail_worker.stop()
+        self.metrics_exporter.stop()
+        self.screen.close()
+        if self.owns_shared:
+            await self.shared.close()
+        if self.capture is not None:
+            self.capture.close()
 
     async def state_changed(self, state: str) -> None:
         if state == 'ws_connected':
             self.has_connected = True
-            self.screen.page_boot()
+            self.connections['moonraker'] += 1
+            if self.synced:
+                # Moonraker 重启或网络断开后重连，屏幕不重新开机
+                await self.resync()
+            if self.screen.transport is not None and (self.boot_pending or not self.synced):
+                # 第一次连接，或者 Moonraker 断开期间串口重新打开过，屏幕需要重新开机
+                self.boot_pending = False
+                self.screen.page_boot()
         elif state == 'ws_stopped':
+            self.subscribed = None
+            self.ws_closed.set()
             if self.has_connected:
                 self.has_connected = False
                 logger.info('Disconnected.')
-                logger.info('Re-connect...')
-            await asyncio.sleep(2)
-            await self.connect()
 
-    async def connect(self):
-        logger.debug('connecting...')
-        await self.screen.start(self.config['Serial'], self.config['Baudrate'])
-        self.screen.set_request_handler(self.on_screen_request)
-        await self.client.connect()
+    def backoff(self):
+        return Backoff(self.config.get('ReconnectDelay', 1), self.config.get('ReconnectMaxDelay', 30))
+
+    async def serial_loop(self):
+        backoff = self.backoff()
+        while True:
+            try:
+                await self.screen.start(self.config['Serial'], self.config['Baudrate'])
+            except Exception as e:
+                delay = backoff.next()
+                logger.error(f'Open serial failed: {e!r}, retry in {delay:.1f}s')
+                await asyncio.sleep(delay)
+                continue
+            backoff.reset()
+            self.connections['serial'] += 1
+            self.screen.set_request_handler(self.scheduler.submit)
+            if self.cpu_fan_state is not None:
+                # 新打开的串口 RTS 为默认值，恢复风扇状态
+                self.screen.set_fan(self.cpu_fan_state)
+            if self.firmware_task is None and self.config.get('UpdateFirmware', False):
+                # 固件在后台下载，期间屏幕命令在队列中等待，不影响与Moonraker的连接
+                self.firmware_task = asyncio.create_task(self.update_firmware())
+            if self.client.is_connected:
+                # 屏幕可能已经断电重启，重新开机；已经同步过的状态直接显示
+                self.screen.page_boot()
+            else:
+                # 等 Moonraker 连接后再开机
+                self.boot_pending = True
+            await self.screen.wait_closed()
+            logger.warning('Serial closed, re-open...')
+
+    async def ws_loop(self):
+        backoff = self.backoff()
+        while True:
+            self.ws_closed.clear()
+            try:
+                logger.debug('connecting...')
+                await self.client.connect()
+            except Exception as e:
+                logger.debug(f'Connect failed: {e!r}')
+                # 等待 websocket 的任务结束后才能再次连接
+                await self.client.disconnect()
+            else:
+                backoff.reset()
+                while self.client.is_connected:
+                    await self.ws_closed.wait()
+                    self.ws_closed.clear()
+            delay = backoff.next()
+            logger.info(f'Re-connect in {delay:.1f}s...')
+            await asyncio.sleep(delay)
+
+    def data_path(self, path):
+        # 多打印机模式下每台打印机使用单独的文件：state.json -> state-<名称>.json
+        if not self.name:
+            return path
+        path = Path(path)
+        return str(path.with_name(f'{path.stem}-{self.name}{path.suffix}'))
+
+    def find_firmware(self):
+        # 返回 (固件, 升级成功后是否删除)
+        files = list(Path('~/printer_data/config').expanduser().glob('*.tft'))
+        if files:
+            # 多台打印机共用同一个固件文件，不删除，由各自的升级记录避免重复升级
+            return files[0], not self.name
+        files = list(Path('.').glob('*.tft'))
+        if files:
+            return files[0], False
+        return None, False
+
+    async def update_firmware(self):
+        firmware, remove = self.find_firmware()
+        if firmware is None:
+            logger.info('Not found firmware!')
+            return
+        digest = await asyncio.to_thread(file_sha256, firmware)
+        record = Path(self.data_path(self.FIRMWARE_RECORD)).expanduser()
+        try:
+            installed = json.loads(record.read_text())
+        except (OSError, ValueError):
+            installed = {}
+        # 上次连接时 comok 应答中的屏幕序列号，换了屏幕需要重新升级
+        serial = self.screen.info.get('serial')
+        same_screen = serial is None or installed.get('screen') in (None, serial)
+        if digest == installed.get('sha256') and same_screen and not remove:
+            logger.info(f'Firmware already installed: {firmware.name} ({self.screen.info.get("model")})')
+            return
+        logger.info(f'Update firmware: {firmware} ({digest[:16]})')
+        start = time.monotonic()
+        if not await self.screen.download_firmware(firmware, self.config.get('FirmwareResume', False)):
+            logger.error('Update firmware failed!')
+            return
+        logger.info(f'Firmware updated in {time.monotonic() - start:.1f}s')
+        try:
+            record.parent.mkdir(parents=True, exist_ok=True)
+            record.write_text(json.dumps({
+                'file': firmware.name, 'sha256': digest, 'screen': self.screen.info.get('serial'), 'time': time.time()}))
+        except OSError as e:
+            logger.error(f'Write firmware record failed: {e}')
+        if remove:
+            firmware.unlink(True)
+        # 屏幕升级后重启，重新显示开机页面
+        self.screen.page_boot()
 
     async def on_exception(self, exception: BaseException) -> None:
         """Notifies of exceptions from the websocket run loop."""
         if self.has_connected:
             logger.debug("Received exception from API websocket %s", str(exception))
 
-    async def _get_files2(self, path):
-        result = await self.call('server.files.get_directory', path=f'gcodes{path}')
-        files = []
-        for item in result['dirs']:
-            if not item['dirname'].startswith('.'):
-                files.append({'name': item['dirname'], 'type': 'directory'})
-        for item in result['files']:
-            _, ext = os.path.splitext(item['filename'])
-            if ext.lower() in ('.gcode', '.gco'):
-                files.append({'name': item['filename'], 'type': 'file'})
-        return files
+    async def load_files(self):
+        result = await self.call('server.files.list', root='gcodes')
+        # server.files.list 不返回目录，空目录需要逐层列出目录
+        dirs = await self.list_dirs()
+        self.files.load(result, dirs)
+
+    async def list_dirs(self):
+        # 每层目录并发请求，返回 gcodes 下所有非隐藏目录，如 '/a/b'
+        dirs = []
+        pending = ['/']
+        while pending:
+            results = await asyncio.gather(
+                *(self.call('server.files.get_directory', path=f'gcodes{directory}') for directory in pending))
+            children = []
+            for directory, result in zip(pending, results):
+                for item in result['dirs']:
+                    if not item['dirname'].startswith('.'):
+                        children.append('/' + fileindex.join_path(directory, item['dirname']))
+            dirs += children
+            pending = children
+        return dirs
 
     async def fs_handler(self, data):
         _, _, page, page_size, path = data.split(' ', maxsplit=4)
@@ -102,13 +326,12 @@ class KlipperScreen(MoonrakerListener):
             if path == '':
                 path = '/'
             page = 0
-        # 获取文件列表，缓存中没有就重新请求
-        if path not in self.fs:
-            self.fs[path] = await self._get_files2(path)
-        files = self.fs.get(path, [])
+        # 文件索引还没有建立就先加载
+        if not self.files.loaded:
+            await self.load_files()
         # 分页处理，格式转换
-        page_max = (len(files) + page_size  -1) // page_size - 1
-        files = files[page*page_size:(page + 1)*page_size]
+        directory = '/' + path.strip('/')
+        files, page_max = self.files.page(directory, page, page_size)
         file_list = []
         file_ext_list = []
         for item in files:
@@ -124,6 +347,28 @@ class KlipperScreen(MoonrakerListener):
             file_ext_list += [' ' for _ in range(padding)]
         # 更新页面
         self.screen.page_file(page, page_max, '|'.join(file_list), '|'.join(file_ext_list), path)
+        # 页面发送后再预取
+        self.cancel_prefetch()
+        self.prefetch_handle = asyncio.get_running_loop().call_soon(self.prefetch, directory, page, page_size)
+
+    def cancel_prefetch(self):
+        if self.prefetch_handle is not None:
+            self.prefetch_handle.cancel()
+            self.prefetch_handle = None
+
+    def prefetch(self, directory, page, page_size):
+        # 预先排序下一页和子目录的列表，并在后台生成当前页和下一页文件的缩略图
+        self.prefetch_handle = None
+        files, _ = self.files.page(directory, page, page_size)
+        next_files, _ = self.files.page(directory, page + 1, page_size)
+        thumbnails = []
+        for item in files + next_files:
+            path = fileindex.join_path(directory, item['name'])
+            if item['type'] == 'directory':
+                self.files.listing('/' + path)
+            elif len(thumbnails) < self.config.get('PrefetchCount', 10):
+                thumbnails.append((path, item['modified']))
+        self.thumbnail_worker.prefetch(thumbnails)
 
     async def on_screen_request(self, data):
         # 处理屏幕发送的请求
@@ -131,17 +376,19 @@ class KlipperScreen(MoonrakerListener):
         fields = data.split(' ')
         group = fields[0]
         if group == 'boot':
+            self.screen.repaint()
             self.screen.send_cmd('boot.tm_notify.en=0')
             await self.initialize()
         elif group == 'g':
             gcode = data.split(' ', maxsplit=1)[-1]
             logger.debug(f'[G-Code] {gcode}')
             if gcode.split(' ')[0] in ('G1',):
-                if not self.homed_axes:
+                if not self.state.homed_axes:
                     self.screen.page_home()
                     return
             await self.call('printer.gcode.script', script=gcode)
         elif group == 'fs':
+            # 新的 fs 请求会取消还未完成的预览（包括缩略图下载），见 RequestScheduler.SUPERSEDE
             if fields[1] == 'ls':
                 await self.fs_handler(data)
             elif fields[1] == 'preview':
@@ -149,6 +396,9 @@ class KlipperScreen(MoonrakerListener):
                 thumbnail = await self.get_thumbnail(filename)
                 await self.screen.page_ask_print(thumbnail)
         elif group == 'print':
+            # 离开文件浏览，取消预取
+            self.cancel_prefetch()
+            self.thumbnail_worker.prefetch([])
             if fields[1] == 'start':
                 filename = data.split(' ', maxsplit=2)[-1].strip('/')
                 await self.call('printer.print.start', filename=filename)
@@ -159,92 +409,119 @@ class KlipperScreen(MoonrakerListener):
             elif fields[1] == 'cancel':
                 await self.call('printer.print.cancel')
         elif group == 'page':
+            self.screen.page_changed(fields[1])
             if fields[1] == 'leveling':
-                if self.bed_mesh_profiles and not self.bed_mesh_profile_name:
-                    gcode = f'BED_MESH_PROFILE LOAD="{self.bed_mesh_profiles[0]}"'
+                # 进入调平页面后才订阅 bed_mesh
+                await self.update_subscriptions()
+                if self.state.bed_mesh_profiles and not self.state.bed_mesh_profile_name:
+                    gcode = f'BED_MESH_PROFILE LOAD="{self.state.bed_mesh_profiles[0]}"'
+                    # 先注册再发送，通知可能在调用返回之前到达
+                    updated = self.wait_state('bed_mesh_probed_matrix')
                     await self.call('printer.gcode.script', script=gcode)
-                    await asyncio.sleep(0.2)
-                self.screen.page_leveling(self.bed_mesh_probed_matrix, 0)
+                    try:
+                        await asyncio.wait_for(updated, self.BED_MESH_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        logger.warning('Bed mesh not updated after profile load')
+                self.screen.page_leveling(self.state.bed_mesh_probed_matrix, 0)
         else:
             logger.error(f'Invalid command: {data}')
 
+    def on_page_changed(self, page):
+        self.renderer.mark_page(page)
+        if page is not None:
+            self.page = page
+            self.schedule_subscriptions()
+
+    def schedule_subscriptions(self):
+        # 页面或打印状态变化后在后台更新订阅，正在更新时由该任务处理最新的变化
+        if self.subscribed is None or (self.subscribe_task is not None and not self.subscribe_task.done()):
+            return
+        self.subscribe_task = asyncio.create_task(self.update_subscriptions())
+
+    async def update_subscriptions(self):
+        # Moonraker 的订阅会替换之前的订阅，返回值包含新订阅对象的当前状态
+        async with self.subscribe_lock:
+            while self.subscribed is not None:
+                fields = printerstate.subscriptions(self.page, self.state)
+                if fields == self.subscribed:
+                    return
+                logger.debug(f'Subscribe: {sorted(fields)}')
+                try:
+                    data = await self.call('printer.objects.subscribe', objects=fields)
+                except Exception as e:
+                    logger.error('Update subscriptions failed', exc_info=e)
+                    return
+                self.subscribed = fields
+                await self.update_status(data['status'])
+
+    def wait_state(self, slot):
+        future = asyncio.get_running_loop().create_future()
+        self.state_waiters.setdefault(slot, []).append(future)
+        return future
+
+    def notify_state_waiters(self, changed):
+        for slot in changed:
+            for future in self.state_waiters.pop(slot, ()):
+                if not future.done():
+                    future.set_result(getattr(self.state, slot))
+
     async def on_notification(self, method: str, data: Any) -> None:
+        if self.capture is not None:
+            self.capture.record_json(capture.NOTIFICATION, {'method': method, 'params': data})
         try:
             await self._on_notification(method, data)
         except Exception as e:
             logger.error("Uncaught exception", exc_info=e)
     
-    def update_state(self, data):
-        vals = {}
-        for category, category_data in data.items():
-            if category == 'heater_bed':
-                for name, val in category_data.items():
-                    if name == 'temperature':
-                        vals['bed_temp'] = val
-                    elif name == 'target':
-                        vals['bed_target_temp'] = val
-            elif category == 'extruder':
-                for name, val in category_data.items():
-                    if name == 'temperature':
-                        vals['extruder_temp'] = val
-                    elif name == 'target':
-                        vals['extruder_target_temp'] = val
-            elif category == 'print_stats':
-                for name, val in category_data.items():
-                    if name == 'state':
-                        vals['print_state'] = val
-                    elif name == 'filename':
-                        vals['filename'] = val
-                    elif name == 'print_duration':
-                        vals['print_duration'] = val
-            elif category == 'fan':
-                for name, val in category_data.items():
-                    if name == 'speed':
-                        vals['fan_speed'] = val
-            elif category == 'gcode_move':
-                for name, val in category_data.items():
-                    if name == 'speed_factor':
-                        vals['print_speed'] = val
-                    elif name == 'gcode_position':
-                        vals['z_value'] = val[2]
-            elif category == 'output_pin LED_pin':
-                for name, val in category_data.items():
-                    if name == 'value':
-                        vals['led_state'] = val
-            elif category == 'toolhead':
-                for name, val in category_data.items():
-                    if name == 'homed_axes':
-                        vals['homed_axes'] = val
-            elif category == 'bed_mesh':
-                for name, val in category_data.items():
-                    if name == 'probed_matrix':
-                        vals['bed_mesh_probed_matrix'] = val
-                        logger.debug('recv value')
-                    elif name == 'profile_name':
-                        vals['bed_mesh_profile_name'] = val
-                    elif name =='profiles':
-                        vals['bed_mesh_profiles'] = list(val.keys())
-            elif category == 'virtual_sdcard':
-                for name, val in category_data.items():
-                    if name == 'file_position':
-                        vals['file_position'] = val
-                        logger.debug(f'file_position: {val}')
-            elif category == 'filament_switch_sensor filament_sensor':
-                for name, val in category_data.items():
-                    if name == 'filament_detected':
-                        vals['filament_detected'] = val
-                        logger.debug(f'filament_detected: {val}')
-            else:
-                logger.debug(f'{category}:{category_data}')
+    async def render_loop(self):
+        # 定时刷新屏幕：moonraker 通知只更新状态，由这里按页面的刷新间隔发送变化的控件
+        while True:
+            await asyncio.sleep(self.renderer.TICK)
+            if self.screen.transport is None:
+                continue
+            try:
+                now = time.monotonic()
+                if self.state_saved is not None and now - self.state_saved > self.STATE_SAVE_INTERVAL:
+                    self.state_saved = now
+                    asyncio.create_task(self.save_state_cache())
+                values = self.renderer.due(now)
+                sent = False
+                for name, value in values:
+                    sent = self.screen.set_control_value(name, value) or sent
+                if values and self.notify_time is not None:
+                    # 值都与屏幕上相同时没有写入串口，这次通知不计入统计
+                    if sent and self.render_notify_time is None:
+                        self.render_notify_time = self.notify_time
+                    self.notify_time = None
+            except Exception as e:
+                logger.error('Render failed', exc_info=e)
+
+    def on_screen_flush(self):
+        if self.render_notify_time is not None:
+            self.metrics.observe('notify_to_serial', self.render_notify_time)
+            self.render_notify_time = None
+
+    def update_progress(self):
+        # 只在进度相关的状态更新时计算，剩余时间按整分钟变化，printtime.txt 每分钟最多发送一次
+        if self.current_file is None:
+            return False
+        self.print_progress = self.get_print_progress()
+        left_time = self.estimator.update(self.print_progress, self.state.print_duration, self.state.print_speed)
+        changed = []
+        if self.state.set('progress', self.print_progress):
+            changed.append('progress')
+        if self.state.set('time_left', left_time):
+            changed.append('time_left')
+        return self.renderer.mark(changed)
+
+    def repaint(self):
+        # 强制刷新屏幕上的所有状态
+        self.screen.repaint()
 
-        for key, val in vals.items():
-            setattr(self, key, val)
-        return vals
-    
     def get_print_progress(self):
-        gcode_start_byte = self.current_file['gcode_start_byte']
-        gcode_end_byte = self.current_file['gcode_end_byte']
-        file_position = self.file_position
+        gcode_start_byte = self.current_file.get('gcode_start_byte')
+        gcode_end_byte = self.current_file.get('gcode_end_byte')
+        file_position = self.state.file_position
         if gcode_start_byte and gcode_end_byte:
             if file_position <= gcode_start_byte:
                 return 0
@@ -257,41 +534,9 @@ class KlipperScreen(MoonrakerListener):
                 return current_position / end_position
         return 0
 
-    def get_print_left_time(self, duration, progress, speed):
-        duration = self.print_duration
-        multiplier = self.print_speed
-        if progress > 0 and duration > 0:
-            file = duration / progress
-            fileLeft = (file - duration) / multiplier
-            return fileLeft
-        return 0
-
-    def format_time(self, duration):
-        duration = int(duration)
-        hour = duration // 3600
-        minute = (duration % 3600) // 60
-        seconds = (duration % 3600) % 60
-        if hour:
-            return f'{hour}h {minute}min {seconds}s'
-        else:
-            return f'{minute}min {seconds}s'
-
-    last_update_time = 0
     async def _on_notification(self, method: str, data: Any) -> None:
         if method == 'notify_status_update':
-            vals = self.update_state(data[0])
-            if 'filament_detected' in vals:
-                if self.config.get('FilamentCheck', False) and self.print_state in ('printing', 'paused'):
-                    self.screen.warning(not self.filament_detected)
-            if 'extruder_temp' in vals or 'extruder_target_temp' in vals:
-                vals['extruder_temp'] = self.extruder_temp
-                vals['extruder_target_temp'] = self.extruder_target_temp
-            if 'bed_temp' in vals or 'bed_target_temp' in vals:
-                vals['bed_temp'] = self.bed_temp
-                vals['bed_target_temp'] = self.bed_target_temp
-            self.screen.global_update(**vals)
-            if 'print_state' in vals and self.print_state in ('printing', 'paused'):
-                self.screen.page_printing_init()
+            await self.update_status(data[0])
         elif method == 'notify_proc_stat_update':
             # 根据CPU温度控制风扇的开和关
             if 'cpu_temp' not in data[0]:
@@ -310,50 +555,116 @@ class KlipperScreen(MoonrakerListener):
                     logger.info('stop cpu fan.')
         elif method == 'notify_gcode_response':
             pass
+        elif method == 'notify_klippy_ready':
+            # Klipper 重启后状态可能已经变化，还没有完成开机的重新开机
+            if self.synced:
+                await self.resync()
+            elif self.screen.transport is not None:
+                self.screen.page_boot()
         elif method == 'notify_history_changed':
             action = data[0]['action']
             logger.debug(data)
             if action == 'added':
-                self.filename = data[0]['job']['filename']
-                self.current_file = await self.call('server.files.metadata', filename=self.filename)
-                thumbnail = await self.get_thumbnail(self.filename)
-                self.screen.page_printing_init(self.filename, thumbnail)
+                self.state.filename = data[0]['job']['filename']
+                self.current_file = None
+                await self.show_printing()
             elif action == 'finished':
-                self.screen.page_finish(self.filename)
+                self.screen.page_finish(self.state.filename)
                 self.current_file = None
-                self.filename = None
+                self.state.filename = None
         elif method == 'notify_filelist_changed':
-            path = data[0]['item']['path']
-            directory = '/'
-            if '/' in path:
-                directory = '/' + path.rsplit('/', maxsplit=1)[0]
-            logger.debug(f'fs change: path={path}, update_dir={directory}')
-            if directory in self.fs:
-                del self.fs[directory]
+            action, item = data[0]['action'], data[0]['item']
+            source_item = data[0].get('source_item')
+            path = item['path']
+            logger.debug(f'fs change: {action} path={path}')
+            if action in ('delete_file', 'modify_file'):
+                self.thumbnails.invalidate(path)
+            elif action == 'move_file' and source_item:
+                self.thumbnails.invalidate(source_item['path'])
+            if self.files.apply(action, item, source_item):
+                await self.load_files()
+            if action in ('create_file', 'modify_file', 'move_file') and fileindex.is_gcode(path):
+                # 等待 moonraker 解析完文件中的缩略图
+                files = [(path, item['modified'])]
+                asyncio.get_running_loop().call_later(self.THUMBNAIL_WARM_DELAY, self.warm_thumbnails, files)
         else:
             logger.debug("Received notification %s -> %s", method, data)
-        
-        # 定时更新打印页面
-        if time.time() - self.last_update_time >= 1:
-            if self.print_state in ('printing', 'paused'):
-                self.print_progress = self.get_print_progress()
-                left_time = self.get_print_left_time(self.print_duration, self.print_progress, self.print_speed)
-                left_time_str = self.format_time(left_time)
-                self.screen.page_printing_update(self.print_progress, left_time_str, self.z_value, self.print_speed)
-            self.last_update_time = time.time()
+
+    async def update_status(self, status):
+        changed = self.state.update(status)
+        self.notify_state_waiters(changed)
+        marked = False
+        if self.PROGRESS_SLOTS & changed and self.state.print_state in ('printing', 'paused'):
+            marked = self.update_progress()
+        if 'filament_detected' in changed:
+            if self.config.get('FilamentCheck', False) and self.state.print_state in ('printing', 'paused'):
+                self.screen.warning(not self.state.filament_detected)
+        # 只有影响控件的通知才开始计时，PAGE_ACTIVE 跳过的控件可能一直留在 dirty 中
+        if self.renderer.mark(changed) or marked:
+            if self.notify_time is None:
+                self.notify_time = time.monotonic()
+        if 'print_state' in changed:
+            self.schedule_subscriptions()
+            if self.state.print_state in ('printing', 'paused'):
+                await self.screen.page_printing_init()
 
     async def call(self, method, **kwargs):
-        return await self.client.call_method(method, **kwargs)
+        start = time.monotonic()
+        result = None
+        try:
+            result = await self.client.call_method(method, **kwargs)
+            return result
+        finally:
+            self.metrics.observe(f'call.{method}', start)
+            if self.capture is not None:
+                self.capture.record_json(capture.CALL, {
+                    'method': method, 'params': kwargs, 'result': result, 'elapsed': time.monotonic() - start})
+
+    def load_state_cache(self):
+        try:
+            return json.loads(Path(self.data_path(self.STATE_CACHE)).expanduser().read_text())
+        except (OSError, ValueError):
+            return None
+
+    async def save_state_cache(self):
+        data = json.dumps({'version': self.version, 'ip': self.ip, 'state': self.state.snapshot()})
+        path = Path(self.data_path(self.STATE_CACHE)).expanduser()
+
+        def write():
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = path.with_name(path.name + '.tmp')
+            tmp.write_text(data)
+            tmp.replace(path)
+        try:
+            await asyncio.to_thread(write)
+        except OSError as e:
+            logger.error(f'Save state cache failed: {e}')
+
+    def render_cached_state(self):
+        # 第一次开机时先用上次保存的状态显示主页面
+        cached, self.cached_state = self.cached_state, None
+        if not cached:
+            return
+        self.state.restore(cached.get('state', {}))
+        self.screen.sys_init(f'http://{cached.get("ip", "")}', cached.get('version', ''))
+        self.renderer.mark()
+        self.screen.page_main_init()
 
     async def initialize(self):
-        # Get klipper version
-        result = await self.call('printer.info')
+        if self.synced:
+            # 串口重新打开或屏幕重启，Moonraker 的状态已经是最新的，只需要重新显示
+            await self.show_state()
+            return
+        self.render_cached_state()
+        # 互不依赖的请求并发发送：版本、IP、文件列表、订阅状态
+        result, self.ip, _, data = await asyncio.gather(
+            self.call('printer.info'),
+            self._get_ip(),
+            self.load_files(),
+            self.subscribe(printerstate.subscriptions(self.page, self.state)))
         self.version = result['software_version'].split('-')[0]
-        # Get IP address
-        self.ip = await self._get_ip()
         logger.info(f'klipper version: {self.version} (@{self.ip})')
-        # Get file list
-        self.fs['/'] = await self._get_files2('/')
+        self.warm_thumbnails(self.files.newest(self.THUMBNAIL_WARM_COUNT))
 
         # Test
         # info = await self.call('printer.objects.list')
@@ -364,62 +675,93 @@ class KlipperScreen(MoonrakerListener):
         #     json.dump(data, fp, indent=4)
 
         # Get Initial states
-        subscribe_fields = {
-            'print_stats': ['state', 'info', 'print_duration', 'filename'],
-            'heater_bed': ['temperature', 'target'],
-            'extruder': ['temperature', 'target'],
-            'toolhead': ['position', 'homed_axes'],
-            'fan': ['speed'],
-            "gcode_move": ["speed_factor", "gcode_position"],
-            'output_pin LED_pin': ['value'],
-            'bed_mesh': ['probed_matrix', 'profile_name', 'profiles'],
-            'virtual_sdcard': ['file_position'],
-            'filament_switch_sensor filament_sensor': ['filament_detected'],
-        }
-        data = await self.subscribe(subscribe_fields)
-        # pprint(data)
-        vals = self.update_state(data['status'])
+        self.state.update(data['status'])
+        # 缓存的打印状态可能已经过时，按实际状态补充订阅
+        await self.update_subscriptions()
+        logger.info(f'Startup State: {self.state.print_state}')
+        await self.show_state()
+        self.synced = True
+        self.state_saved = time.monotonic()
+        await self.save_state_cache()
+
+    async def show_state(self):
         self.screen.sys_init(f'http://{self.ip}', self.version)
-        logger.info(f'Startup State: {self.print_state}')
-        self.screen.global_update(**vals)
-        if self.print_state in ('printing', 'paused'):
-            self.current_file = await self.call('server.files.metadata', filename=self.filename)
-            self.print_progress = self.get_print_progress()
-            thumbnail = await self.get_thumbnail(self.filename)
-            self.screen.page_printing_init(self.filename, thumbnail)
-            left_time = self.get_print_left_time(self.print_duration, self.print_progress, self.print_speed)
-            left_time_str = self.format_time(left_time)
-            self.screen.page_printing_update(self.print_progress, left_time_str, self.z_value, self.print_speed)
+        self.renderer.mark()
+        if self.state.print_state in ('printing', 'paused'):
+            await self.show_printing()
         else:
             self.screen.page_main_init()
 
+    async def show_printing(self):
+        if self.current_file is None or self.current_file.get('filename') != self.state.filename:
+            self.current_file = await self.call('server.files.metadata', filename=self.state.filename)
+            self.estimator.reset(self.current_file.get('estimated_time'))
+        thumbnail = await self.get_thumbnail(self.state.filename, self.current_file.get('modified'))
+        await self.screen.page_printing_init(self.state.filename, thumbnail)
+        # 进度和剩余时间平时只在进度相关的状态更新时计算，暂停中启动时不会更新
+        self.update_progress()
+
+    async def resync(self):
+        # 重新订阅，返回的状态与当前状态比较，只刷新变化的控件；
+        # 文件索引和缩略图缓存保留，断开期间错过的文件变化在后台重新加载
+        start = time.monotonic()
+        printing = self.state.print_state in ('printing', 'paused')
+        filename = self.state.filename
+        try:
+            result, ip, data = await asyncio.gather(
+                self.call('printer.info'),
+                self._get_ip(),
+                self.subscribe(printerstate.subscriptions(self.page, self.state)))
+        except Exception as e:
+            logger.error('Resync failed', exc_info=e)
+            return
+        if 'status' not in data:
+            # Klippy 还没有就绪，收到 notify_klippy_ready 后再同步
+            logger.warning(f'Resync deferred: {data.get("error")}')
+            return
+        self.connections['resync'] += 1
+        version = result.get('software_version', '').split('-')[0] or self.version
+        if (version, ip) != (self.version, self.ip):
+            self.version, self.ip = version, ip
+            self.screen.sys_init(f'http://{self.ip}', self.version)
+        await self.update_status(data['status'])
+        if self.state.print_state in ('printing', 'paused'):
+            if not printing or self.state.filename != filename:
+                await self.show_printing()
+        elif printing:
+            self.screen.page_finish(filename)
+            self.current_file = None
+        asyncio.create_task(self.load_files())
+        self.metrics.observe('resync', start)
+        logger.info(f'Resynced, state: {self.state.print_state}')
+
+    async def _get_modified(self, filename):
+        # 优先从文件索引中获取修改时间
+        item = self.files.get(filename)
+        if item is not None:
+            return item['modified']
+        metadata = await self.call('server.files.metadata', filename=filename)
+        return metadata['modified']
+
+    async def get_thumbnail(self, filename, modified=None):
+        if modified is None:
+            modified = await self._get_modified(filename)
+        data = self.thumbnails.get(filename, modified, 160, 160)
+        if data is not None:
+            return data
+        future = self.thumbnail_worker.submit(filename, modified, thumbnail.ThumbnailWorker.PRIORITY_PREVIEW)
+        try:
+            return await asyncio.shield(future)
+        except asyncio.CancelledError:
+            self.thumbnail_worker.cancel(filename, modified)
+            raise
+
+    def warm_thumbnails(self, files):
+        # 后台预生成缩略图，files: [(filename, modified), ...]
+        for filename, modified in files:
+            self.thumbnail_worker.warm(filename, modified)
 
-    def _create_thumbnail(self, filename, width, height, fillcolor=0):
-        im = Image.open(filename)
-        im = im.rotate(270, expand=True)
-        w, h = im.size
-        if w != width or h != height:
-            scale_w = w / width
-            scale_h = h / height
-            if scale_w != scale_h:
-                if scale_w > scale_h:
-                    new_w = w
-                    new_h = int(height * scale_w)
-                    pos = (0, (new_h - h) // 2)
-                else:
-                    new_w = int(width * scale_h)
-                    new_h = h
-                    pos = ((new_w - w) // 2, 0)
-                new_im = Image.new('RGB', (new_w, new_h), fillcolor)
-                new_im.paste(im, pos)
-                im = new_im
-            im = im.resize((width, height))
-        fp = io.BytesIO()
-        im = im.convert('RGB')
-        im.save(fp, format='jpeg')
-        return fp.getvalue()
-
-    async def get_thumbnail(self, filename):
+    async def _render_thumbnail(self, filename):
         thumbnails = await self.call('server.files.thumbnails', filename=filename)
         max_width = 0
         perfer_input = None
@@ -432,14 +774,32 @@ class KlipperScreen(MoonrakerListener):
                 perfer_input = item['thumbnail_path']
         
         if perfer_input:
-            resp = requests.get(f'http://{self.client.host}:{self.client.port}/server/files/gcodes/{perfer_input}')
-            fp = io.BytesIO(resp.content)
-            return self._create_thumbnail(fp, 160, 160)
+            start = time.monotonic()
+            fp = io.BytesIO(await self.fetch_file(f'gcodes/{perfer_input}'))
+            self.metrics.observe('thumbnail.fetch', start)
+            loop = asyncio.get_running_loop()
+            max_bytes = self.config.get('ThumbnailMaxBytes', 8192)
+            start = time.monotonic()
+            data = await loop.run_in_executor(self.thumbnail_pool, thumbnail.create_thumbnail, fp, 160, 160, 0, max_bytes)
+            self.metrics.observe('thumbnail.render', start)
+            return data
+
+    def _get_http(self):
+        return self.shared.get_http()
+
+    async def fetch_file(self, path):
+        url = f'http://{self.client.host}:{self.client.port}/server/files/{path}'
+        async with self._get_http().get(url) as resp:
+            resp.raise_for_status()
+            return await resp.read()
 
     async def subscribe(self, fields):
         logger.info('Subscribe notifications')
         await self.call('printer.objects.subscribe')
-        return await self.call('printer.objects.subscribe', objects=fields)
+        data = await self.call('printer.objects.subscribe', objects=fields)
+        if 'status' in data:
+            self.subscribed = fields
+        return data
 
     async def _get_ip(self):
         info = await self.call('machine.system_info')
@@ -452,23 +812,9 @@ class KlipperScreen(MoonrakerListener):
         return ip
 
 
-def check_and_update_firmware(config: dict):
-    if not config.get('UpdateFirmware', False):
-        return
-    files = list(Path('~/printer_data/config').glob('*.tft'))
-    if files:
-        screen = tjc.TJC(config['Serial'])
-        if screen.download_firmware(files[0], True):
-            files[0].unlink(True)
-        screen.close()
-    else:
-        files = list(Path('.').glob('*.tft'))
-        if files:
-            screen = tjc.TJC(config['Serial'])
-            screen.download_firmware(files[0], True)
-            screen.close()
-        else:
-            logger.info('Not found firmware!')
+# 多打印机模式下只在外层生效、不传给每台打印机的配置
+PRINTER_EXCLUDED_KEYS = ('MetricsFile', 'MetricsSocket', 'CaptureFile')
+
 
 async def main():
     config_file = Path('~/printer_data/config/neptune-screen.json').expanduser().resolve()
@@ -476,11 +822,39 @@ async def main():
     with open(config_file, 'r') as fp:
         config = json.load(fp)
 
-    # 自动更新固件
-    check_and_update_firmware(config)
+    printers = config.pop('Printers', None)
+    if not printers:
+        klipperScreen = KlipperScreen(config)
+        await klipperScreen.start()
+        # 连接由后台任务维护，在这里保持引用
+        await asyncio.gather(klipperScreen.serial_task, klipperScreen.ws_task)
+        return
 
-    klipperScreen = KlipperScreen(config)
-    await klipperScreen.start()
+    # 多打印机模式：Printers 中的每一项覆盖外层的配置，共用缩略图和 HTTP 连接池，统计统一导出
+    shared = SharedResources(config, len(printers))
+    group = metrics.MetricsGroup()
+    screens = []
+    for index, item in enumerate(printers):
+        printer_config = {key: value for key, value in config.items() if key not in PRINTER_EXCLUDED_KEYS}
+        printer_config.update(item)
+        printer_config.setdefault('Name', f'printer{index + 1}')
+        # 配置错误的打印机跳过，不影响其他打印机
+        try:
+            screen = KlipperScreen(printer_config, shared)
+        except Exception as e:
+            logger.error(f'Create {printer_config["Name"]} failed: {e!r}')
+            continue
+        group.add(printer_config['Name'], screen.metrics)
+        screens.append(screen)
+    exporter = metrics.MetricsExporter(group, config.get('MetricsFile'), config.get('MetricsSocket'), config.get('MetricsInterval', 10))
+    await exporter.start()
+    # 每台打印机独立启动，一台失败不影响其他
+    results = await asyncio.gather(*(screen.start() for screen in screens), return_exceptions=True)
+    for screen, result in zip(screens, results):
+        if isinstance(result, BaseException):
+            logger.error(f'Start {screen.name} failed: {result!r}')
+    tasks = [task for screen in screens for task in (screen.serial_task, screen.ws_task) if task is not None]
+    await asyncio.gather(*tasks, return_exceptions=True)
 
 if __name__ == "__main__":
     loop = asyncio.new_event_loop()
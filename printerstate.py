@@ -0,0 +1,220 @@
+import logging
+
+logger = logging.getLogger('PrinterState')
+logger.setLevel(logging.INFO)
+
+
+def _z(position):
+    return position[2]
+
+
+def _keys(profiles):
+    return list(profiles.keys())
+
+
+def format_time(duration):
+    # 剩余时间按整分钟估计，只显示到分钟
+    minutes = int(duration) // 60
+    hour, minute = divmod(minutes, 60)
+    if hour:
+        return f'{hour}h {minute}min'
+    else:
+        return f'{minute}min'
+
+
+# 订阅的 Klipper 状态：(对象, 字段, 状态名, 默认值, 转换函数)
+STATE_FIELDS = (
+    ('print_stats', 'state', 'print_state', '', None),
+    ('print_stats', 'filename', 'filename', None, None),
+    ('print_stats', 'print_duration', 'print_duration', 0, None),
+    ('heater_bed', 'temperature', 'bed_temp', 0, None),
+    ('heater_bed', 'target', 'bed_target_temp', 0, None),
+    ('extruder', 'temperature', 'extruder_temp', 0, None),
+    ('extruder', 'target', 'extruder_target_temp', 0, None),
+    ('toolhead', 'homed_axes', 'homed_axes', '', None),
+    ('fan', 'speed', 'fan_speed', 0, None),
+    ('gcode_move', 'speed_factor', 'print_speed', 1, None),
+    ('gcode_move', 'gcode_position', 'z_value', 0, _z),
+    ('output_pin LED_pin', 'value', 'led_state', 0, None),
+    ('bed_mesh', 'probed_matrix', 'bed_mesh_probed_matrix', None, None),
+    ('bed_mesh', 'profile_name', 'bed_mesh_profile_name', None, None),
+    ('bed_mesh', 'profiles', 'bed_mesh_profiles', None, _keys),
+    ('virtual_sdcard', 'file_position', 'file_position', 0, None),
+    ('filament_switch_sensor filament_sensor', 'filament_detected', 'filament_detected', False, None),
+)
+
+# 由程序计算的状态：(状态名, 默认值)
+DERIVED_FIELDS = (
+    ('progress', 0),
+    ('time_left', 0),
+)
+
+# 屏幕控件：(控件名, 依赖的状态, 计算显示值)，控件按名称前缀的页面分组刷新
+CONTROLS = (
+    ('main.nozzletemp.txt', ('extruder_temp', 'extruder_target_temp'),
+        lambda s: f'{s.extruder_temp:3.0f} / {s.extruder_target_temp:0.0f}'),
+    ('main.bedtemp.txt', ('bed_temp', 'bed_target_temp'),
+        lambda s: f'{s.bed_temp:3.0f} / {s.bed_target_temp:0.0f}'),
+    ('led_state', ('led_state',), lambda s: 0 if s.led_state == 0 else 1),
+    ('fan_speed', ('fan_speed',), lambda s: int(s.fan_speed * 100)),
+    ('paused', ('print_state',), lambda s: 1 if s.print_state == 'paused' else 0),
+    ('printpause.printprocess.val', ('progress',), lambda s: int(s.progress*100)),
+    ('printpause.printvalue.txt', ('progress',), lambda s: str(int(s.progress*100))),
+    ('printpause.printtime.txt', ('time_left',), lambda s: format_time(s.time_left)),
+    ('printpause.zvalue.val', ('z_value',), lambda s: int(s.z_value*100)),
+    ('printpause.printspeed.txt', ('print_speed',), lambda s: str(int(s.print_speed*100))),
+)
+
+# 只在条件满足时刷新的页面
+PAGE_ACTIVE = {
+    'printpause': lambda s: s.print_state in ('printing', 'paused'),
+}
+
+def _printing(page, s):
+    return s.print_state in ('printing', 'paused')
+
+
+# 只在条件满足时订阅的对象，其他对象一直订阅：对象 -> 条件(当前页面, 状态)
+SUBSCRIBE_WHEN = {
+    'bed_mesh': lambda page, s: page == 'leveling',
+    'virtual_sdcard': _printing,
+    'gcode_move': _printing,
+}
+
+# 各页面的最短刷新间隔（秒），heating 用于加热过程中的 main 页面
+REFRESH_INTERVALS = {
+    'global': 0.1,
+    'main': 1.0,
+    'heating': 0.25,
+    'printpause': 1.0,
+}
+
+# 对象 -> 字段 -> (状态名, 转换函数)
+_FIELD_MAP = {}
+for _object, _field, _slot, _, _convert in STATE_FIELDS:
+    _FIELD_MAP.setdefault(_object, {})[_field] = (_slot, _convert)
+
+
+def _page_of(name):
+    page, sep, _ = name.partition('.')
+    return page if sep else 'global'
+
+
+_CONTROLS = {name: (_page_of(name), render) for name, _, render in CONTROLS}
+_DEPENDENTS = {}
+for _name, _deps, _ in CONTROLS:
+    for _slot in _deps:
+        _DEPENDENTS.setdefault(_slot, []).append(_name)
+
+
+def subscriptions(page=None, state=None):
+    # state 为 None 时返回全部对象
+    return {
+        name: list(fields) for name, fields in _FIELD_MAP.items()
+        if state is None or name not in SUBSCRIBE_WHEN or SUBSCRIBE_WHEN[name](page, state)
+    }
+
+
+class PrinterState:
+    __slots__ = tuple(slot for _, _, slot, _, _ in STATE_FIELDS) + tuple(slot for slot, _ in DERIVED_FIELDS)
+
+    def __init__(self):
+        for _, _, slot, default, _ in STATE_FIELDS:
+            setattr(self, slot, default)
+        for slot, default in DERIVED_FIELDS:
+            setattr(self, slot, default)
+
+    @property
+    def heating(self):
+        return ((self.extruder_target_temp > 0 and abs(self.extruder_target_temp - self.extruder_temp) > 2)
+            or (self.bed_target_temp > 0 and abs(self.bed_target_temp - self.bed_temp) > 2))
+
+    def snapshot(self):
+        # 可以保存为 json 的状态，下次启动时先用来显示
+        return {slot: getattr(self, slot) for _, _, slot, _, _ in STATE_FIELDS}
+
+    def restore(self, data):
+        for _, _, slot, _, _ in STATE_FIELDS:
+            if slot in data:
+                setattr(self, slot, data[slot])
+
+    def set(self, slot, val):
+        if getattr(self, slot) == val:
+            return False
+        setattr(self, slot, val)
+        return True
+
+    def update(self, data):
+        # 更新状态，返回值发生变化的状态名
+        changed = set()
+        for name, fields in data.items():
+            mapping = _FIELD_MAP.get(name)
+            if mapping is None:
+                logger.debug(f'{name}:{fields}')
+                continue
+            for field, val in fields.items():
+                entry = mapping.get(field)
+                if entry is None:
+                    continue
+                slot, convert = entry
+                if convert is not None:
+                    val = convert(val)
+                if getattr(self, slot) != val:
+                    setattr(self, slot, val)
+                    changed.add(slot)
+        return changed
+
+
+class Renderer:
+    # 按页面的刷新间隔，只重新计算并发送状态发生变化的控件
+    TICK = 0.05
+
+    def __init__(self, state, intervals=None):
+        self.state = state
+        self.intervals = dict(REFRESH_INTERVALS)
+        self.intervals.update(intervals or {})
+        self.dirty = set()
+        self.last_render = {}
+
+    def mark(self, changed=None):
+        # changed 为 None 时刷新全部控件；返回是否有控件依赖变化的状态
+        if changed is None:
+            self.dirty.update(_CONTROLS)
+            return True
+        marked = False
+        for slot in changed:
+            controls = _DEPENDENTS.get(slot)
+            if controls:
+                self.dirty.update(controls)
+                marked = True
+        return marked
+
+    def mark_page(self, page=None):
+        # 切换页面后，该页面和不带页面前缀的控件需要重新发送
+        if page is None:
+            self.mark()
+            return
+        self.dirty.update(name for name, (group, _) in _CONTROLS.items() if group in (page, 'global'))
+
+    def interval(self, group):
+        if group == 'main' and self.state.heating:
+            return self.intervals['heating']
+        return self.intervals.get(group, self.intervals['global'])
+
+    def due(self, now):
+        # 返回到了刷新时间的 (控件, 值)
+        result = []
+        rendered = set()
+        for name in list(self.dirty):
+            group, render = _CONTROLS[name]
+            active = PAGE_ACTIVE.get(group)
+            if active is not None and not active(self.state):
+                continue
+            if group not in rendered and now - self.last_render.get(group, 0) < self.interval(group):
+                continue
+            rendered.add(group)
+            self.dirty.discard(name)
+            result.append((name, render(self.state)))
+        for group in rendered:
+            self.last_render[group] = now
+        return result
@@ -0,0 +1,172 @@
+import time
+import asyncio
+import logging
+from collections import deque
+
+logger = logging.getLogger('Scheduler')
+logger.setLevel(logging.INFO)
+
+JOG_AXES = 'XYZE'
+
+
+def parse_jog(script, relative):
+    # 解析点动命令：'G91\nG1 X10 F3000\nG90'，或相对坐标模式下的 'G1 X10'
+    # 返回 (格式, 命令, {轴: 距离}, 速度)，不是点动命令返回 None
+    lines = [line.strip().upper() for line in script.strip().split('\n') if line.strip()]
+    if len(lines) == 3 and lines[0] == 'G91' and lines[2] == 'G90':
+        form, move = 'wrapped', lines[1]
+    elif len(lines) == 1 and relative:
+        form, move = 'plain', lines[0]
+    else:
+        return None
+    words = move.split()
+    if words[0] not in ('G0', 'G1') or len(words) < 2:
+        return None
+    axes = {}
+    feed = None
+    for word in words[1:]:
+        try:
+            value = float(word[1:])
+        except ValueError:
+            return None
+        if word[0] in JOG_AXES:
+            axes[word[0]] = axes.get(word[0], 0) + value
+        elif word[0] == 'F':
+            feed = value
+        else:
+            return None
+    return form, words[0], axes, feed
+
+
+def format_jog(jog):
+    form, cmd, axes, feed = jog
+    move = ' '.join([cmd] + [f'{axis}{axes[axis]:g}' for axis in JOG_AXES if axis in axes])
+    if feed is not None:
+        move += f' F{feed:g}'
+    if form == 'wrapped':
+        return f'G91\n{move}\nG90'
+    return move
+
+
+class _Request:
+    __slots__ = ('data', 'group', 'time', 'jog')
+
+    def __init__(self, data, group, jog=None):
+        self.data = data
+        self.group = group
+        self.time = time.monotonic()
+        self.jog = jog
+
+
+class RequestScheduler:
+    # 屏幕请求按组排队，同组内按顺序执行，不同组并发执行（有上限）
+    # 新请求到来时取消的组：文件浏览/预览只保留最新的请求
+    SUPERSEDE = {
+        'fs': ('fs',),
+        'print': ('fs',),
+    }
+
+    def __init__(self, handler, max_concurrency=4, metrics=None):
+        self.handler = handler
+        # metrics.Metrics，记录从屏幕请求到处理完成的时间
+        self.metrics = metrics
+        self.queues = {}
+        self.running = {}
+        self.semaphore = asyncio.Semaphore(max_concurrency)
+        # 根据已发送的 G90/G91 推断的坐标模式，None 表示未知
+        self.relative = None
+        self.requests = 0
+        self.started = 0
+        self.merged = 0
+        self.cancelled = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    def submit(self, data):
+        group = data.split(' ', maxsplit=1)[0]
+        self.requests += 1
+        for other in self.SUPERSEDE.get(group, ()):
+            self.cancel(other)
+        queue = self.queues.setdefault(group, deque())
+        request = _Request(data, group)
+        if group == 'g':
+            script = data.split(' ', maxsplit=1)[-1]
+            request.jog = parse_jog(script, self.relative)
+            self._update_mode(script)
+            if queue and self._merge(queue[-1], request):
+                self.merged += 1
+                return
+        queue.append(request)
+        self._next(group)
+
+    def _update_mode(self, script):
+        for line in script.upper().split('\n'):
+            words = line.split()
+            if words and words[0] == 'G90':
+                self.relative = False
+            elif words and words[0] == 'G91':
+                self.relative = True
+
+    def _merge(self, last, request):
+        # 连续的相对移动合并为一次移动，只合并移动相同的轴且速度相同的点动，
+        # 否则例如挤出和 XY 移动合并后会边移动边挤出
+        if last.jog is None or request.jog is None or last.jog[:2] != request.jog[:2]:
+            return False
+        form, cmd, axes, feed = last.jog
+        if axes.keys() != request.jog[2].keys() or feed != request.jog[3]:
+            return False
+        axes = {axis: value + request.jog[2][axis] for axis, value in axes.items()}
+        last.jog = (form, cmd, axes, feed)
+        last.data = 'g ' + format_jog(last.jog)
+        return True
+
+    def cancel(self, group):
+        queue = self.queues.get(group)
+        if queue:
+            self.cancelled += len(queue)
+            queue.clear()
+        task = self.running.get(group)
+        if task is not None and not task.done():
+            self.cancelled += 1
+            task.cancel()
+
+    def _next(self, group):
+        if group in self.running:
+            return
+        queue = self.queues.get(group)
+        if queue:
+            request = queue.popleft()
+            task = self.running[group] = asyncio.create_task(self._run(request))
+            # 任务在开始执行前被取消时 _run 不会运行，在回调中清理
+            task.add_done_callback(lambda task: self._done(group, task))
+
+    def _done(self, group, task):
+        if self.running.get(group) is task:
+            del self.running[group]
+            self._next(group)
+
+    async def _run(self, request):
+        try:
+            async with self.semaphore:
+                latency = time.monotonic() - request.time
+                self.started += 1
+                self.latency_total += latency
+                self.latency_max = max(self.latency_max, latency)
+                await self.handler(request.data)
+            if self.metrics is not None:
+                self.metrics.observe(f'request.{request.group}', request.time)
+        except asyncio.CancelledError:
+            logger.debug(f'Request cancelled: {request.data}')
+        except Exception as e:
+            logger.error(f'Request failed: {request.data}', exc_info=e)
+
+    def stats(self):
+        return {
+            'requests': self.requests,
+            'merged': self.merged,
+            'cancelled': self.cancelled,
+            'queued': {group: len(queue) for group, queue in self.queues.items() if queue},
+            'running': list(self.running),
+            'latency_avg': self.latency_total / self.started if self.started else 0,
+            'latency_max': self.latency_max,
+        }
@@ -0,0 +1,286 @@
+import io
+import os
+import time
+import asyncio
+import hashlib
+import logging
+from pathlib import Path
+from collections import OrderedDict
+
+logger = logging.getLogger('Thumbnail')
+logger.setLevel(logging.INFO)
+
+# 依次尝试的 jpeg 质量，直到文件大小满足 max_bytes
+JPEG_QUALITY_STEPS = (90, 80, 70, 60, 50, 40, 30)
+
+
+def create_thumbnail(fp, width, height, fillcolor=0, max_bytes=None):
+    # 旋转270度，等比例缩放并居中填充到 width x height，输出 jpeg
+    from PIL import Image, ImageOps
+    im = Image.open(fp)
+    if im.format == 'JPEG':
+        # jpeg 直接按接近目标的尺寸解码，旋转前宽高互换
+        im.draft('RGB', (height, width))
+    im = im.convert('RGB')
+    im = im.transpose(getattr(Image, 'Transpose', Image).ROTATE_270)
+    if im.size != (width, height):
+        im = ImageOps.pad(im, (width, height), color=fillcolor)
+    qualities = JPEG_QUALITY_STEPS if max_bytes else (75,)
+    for quality in qualities:
+        out = io.BytesIO()
+        im.save(out, format='jpeg', quality=quality, subsampling='4:2:0', optimize=True)
+        if not max_bytes or out.tell() <= max_bytes:
+            break
+    else:
+        logger.debug(f'Thumbnail exceeds {max_bytes} bytes: {out.tell()}')
+    return out.getvalue()
+
+
+class ThumbnailCache:
+    # 缓存转换好的屏幕缩略图(jpeg)，文件名由 gcode 路径、修改时间、尺寸决定
+    def __init__(self, path, max_size=20*1024*1024):
+        self.path = Path(path).expanduser()
+        self.max_size = max_size
+        # 缓存文件名 -> 文件大小，按最近使用排序
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        try:
+            self.path.mkdir(parents=True, exist_ok=True)
+            self._load()
+        except OSError as e:
+            logger.error(f'Thumbnail cache disabled: {e}')
+            self.path = None
+
+    def _load(self):
+        files = []
+        for file in self.path.glob('*.jpg'):
+            stat = file.stat()
+            files.append((stat.st_mtime, file.name, stat.st_size))
+        for _, name, size in sorted(files):
+            self.entries[name] = size
+            self.size += size
+        self._evict()
+        logger.info(f'Thumbnail cache: {len(self.entries)} files, {self.size} bytes')
+
+    @staticmethod
+    def file_id(filename):
+        return hashlib.sha1(filename.encode('utf-8')).hexdigest()[:16]
+
+    def key(self, filename, modified, width, height):
+        return f'{self.file_id(filename)}-{int(modified * 1000)}-{width}x{height}.jpg'
+
+    def contains(self, filename, modified, width, height):
+        return self.path is not None and self.key(filename, modified, width, height) in self.entries
+
+    def get(self, filename, modified, width, height):
+        if self.path is None:
+            return None
+        name = self.key(filename, modified, width, height)
+        if name not in self.entries:
+            self.misses += 1
+            return None
+        try:
+            data = (self.path / name).read_bytes()
+        except OSError:
+            self._remove(name)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(name)
+        self.hits += 1
+        return data
+
+    def put(self, filename, modified, width, height, data):
+        if self.path is None:
+            return
+        name = self.key(filename, modified, width, height)
+        tmp = self.path / f'{name}.tmp'
+        try:
+            tmp.write_bytes(data)
+            os.replace(tmp, self.path / name)
+        except OSError as e:
+            logger.error(f'Write thumbnail cache failed: {e}')
+            return
+        if name in self.entries:
+            self.size -= self.entries[name]
+        self.entries[name] = len(data)
+        self.entries.move_to_end(name)
+        self.size += len(data)
+        self._evict()
+
+    def invalidate(self, filename):
+        if self.path is None:
+            return
+        prefix = self.file_id(filename) + '-'
+        for name in [name for name in self.entries if name.startswith(prefix)]:
+            self._remove(name)
+
+    def _evict(self):
+        while self.size > self.max_size and self.entries:
+            self._remove(next(iter(self.entries)))
+
+    def _remove(self, name):
+        self.size -= self.entries.pop(name)
+        try:
+            (self.path / name).unlink()
+        except OSError:
+            pass
+
+
+class CacheNamespace:
+    # 多台打印机共用一个 ThumbnailCache，文件名加上打印机名称区分
+    def __init__(self, cache, namespace):
+        self.cache = cache
+        self.namespace = namespace
+
+    def _name(self, filename):
+        return f'{self.namespace}:{filename}'
+
+    def contains(self, filename, modified, width, height):
+        return self.cache.contains(self._name(filename), modified, width, height)
+
+    def get(self, filename, modified, width, height):
+        return self.cache.get(self._name(filename), modified, width, height)
+
+    def put(self, filename, modified, width, height, data):
+        self.cache.put(self._name(filename), modified, width, height, data)
+
+    def invalidate(self, filename):
+        self.cache.invalidate(self._name(filename))
+
+
+class _Job:
+    __slots__ = ('filename', 'modified', 'priority', 'future', 'task')
+
+    def __init__(self, filename, modified, priority, future):
+        self.filename = filename
+        self.modified = modified
+        self.priority = priority
+        self.future = future
+        self.task = None
+
+    @property
+    def running(self):
+        return self.task is not None
+
+
+class ThumbnailWorker:
+    # 按优先级生成缩略图：屏幕预览请求优先，后台预生成排在最后
+    PRIORITY_PREVIEW = 0
+    PRIORITY_PREFETCH = 1
+    PRIORITY_BACKGROUND = 2
+
+    def __init__(self, cache, render, width=160, height=160, workers=1):
+        self.cache = cache
+        # async render(filename) -> bytes | None
+        self.render = render
+        self.width = width
+        self.height = height
+        self.workers = workers
+        self.queue = asyncio.PriorityQueue()
+        self.jobs = {}
+        self.tasks = []
+        self.seq = 0
+        self.rendered = 0
+        self.failed = 0
+        self.render_time = 0.0
+        self.max_render_time = 0.0
+
+    def start(self):
+        if not self.tasks:
+            self.tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks = []
+        for job in self.jobs.values():
+            if job.running:
+                job.task.cancel()
+            job.future.cancel()
+        self.jobs.clear()
+
+    def submit(self, filename, modified, priority=PRIORITY_BACKGROUND):
+        key = (filename, modified)
+        job = self.jobs.get(key)
+        if job is None:
+            job = _Job(filename, modified, priority, asyncio.get_running_loop().create_future())
+            self.jobs[key] = job
+        elif job.running or priority >= job.priority:
+            return job.future
+        # 已在队列中的任务提升优先级，旧的队列项在取出时跳过
+        job.priority = priority
+        self.seq += 1
+        self.queue.put_nowait((priority, self.seq, key))
+        return job.future
+
+    def cancel(self, filename, modified):
+        # 取消排队或正在进行的任务（如正在下载的缩略图）
+        job = self.jobs.get((filename, modified))
+        if job is None:
+            return
+        if job.running:
+            job.task.cancel()
+        else:
+            del self.jobs[(filename, modified)]
+            job.future.cancel()
+
+    def prefetch(self, files):
+        # 预取当前浏览位置附近的缩略图，之前位置的预取任务全部取消
+        keys = set(files)
+        for key, job in list(self.jobs.items()):
+            if job.priority == self.PRIORITY_PREFETCH and key not in keys:
+                self.cancel(*key)
+        for filename, modified in files:
+            if not self.cache.contains(filename, modified, self.width, self.height):
+                self.submit(filename, modified, self.PRIORITY_PREFETCH)
+
+    def warm(self, filename, modified):
+        if not self.cache.contains(filename, modified, self.width, self.height):
+            self.submit(filename, modified, self.PRIORITY_BACKGROUND)
+
+    async def _run(self):
+        while True:
+            priority, _, key = await self.queue.get()
+            job = self.jobs.get(key)
+            if job is None or job.running or job.priority != priority:
+                continue
+            start = time.monotonic()
+            job.task = asyncio.create_task(self._render(job))
+            await asyncio.wait((job.task,))
+            del self.jobs[key]
+            elapsed = time.monotonic() - start
+            self.render_time += elapsed
+            self.max_render_time = max(self.max_render_time, elapsed)
+            if job.task.cancelled():
+                logger.debug(f'Render thumbnail cancelled: {job.filename}')
+                job.future.cancel()
+            elif not job.future.done():
+                job.future.set_result(job.task.result())
+
+    async def _render(self, job):
+        try:
+            data = None
+            if self.cache.contains(job.filename, job.modified, self.width, self.height):
+                data = self.cache.get(job.filename, job.modified, self.width, self.height)
+            if data is None:
+                data = await self.render(job.filename)
+                if data is not None:
+                    self.cache.put(job.filename, job.modified, self.width, self.height, data)
+            self.rendered += 1
+            return data
+        except Exception as e:
+            self.failed += 1
+            logger.error(f'Render thumbnail failed: {job.filename}: {e!r}')
+
+    def stats(self):
+        done = self.rendered + self.failed
+        return {
+            'queue_depth': sum(1 for job in self.jobs.values() if not job.running),
+            'running': sum(1 for job in self.jobs.values() if job.running),
+            'rendered': self.rendered,
+            'failed': self.failed,
+            'avg_render_time': self.render_time / done if done else 0,
+            'max_render_time': self.max_render_time,
+        }
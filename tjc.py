@@ -1,47 +1,151 @@
+import os
+import json
 import time
 import struct
-import serial
 import asyncio
-import serial_asyncio
 import logging
 from pathlib import Path
+from collections import OrderedDict
+from capture import SERIAL_TX, SERIAL_RX
 
 logger = logging.getLogger('TJC')
 logger.setLevel(logging.DEBUG)
 
-import functools
-def my_decorator(f):
-    cached = {}
-    @functools.wraps(f)
-    def wrapper(self, name, value):
-        if name not in cached or cached[name] != value:
-            cached[name] = value
-            return f(self, name, value)
-    return wrapper
+BAUDRATE_LIST = (512000, 115200, 9600, 921600)
+# 记录上次连接成功的波特率和屏幕信息
+SCREEN_STATE_FILE = '~/printer_data/neptune-screen/screen.json'
+# connect 的应答，如 'comok 1,30614-0,TJC4832T135_011R,52,61488,D264B8204F0E1828,16777216'
+COMOK_FIELDS = ('touch', 'reserved', 'model', 'firmware', 'mcu', 'serial', 'flash_size')
+COMOK_SIZE = 80
+# 调平页面的网格，x0 ~ x35 按蛇形顺序排列
+LEVELING_GRID = (6, 6)
+TERMINATOR = b'\xff\xff\xff'
+
+
+def parse_comok(data):
+    pos = data.find(b'comok ')
+    if pos == -1:
+        return None
+    end = data.find(b'\xff\xff\xff', pos)
+    fields = data[pos + 6:end if end != -1 else len(data)].decode(errors='replace').split(',')
+    return dict(zip(COMOK_FIELDS, fields))
+
+
+def mesh_values(matrix):
+    # 网格按蛇形顺序展开（偶数行反向），转换为屏幕使用的 0.01mm 单位，支持任意大小的网格
+    if not matrix or not matrix[0]:
+        rows, cols = LEVELING_GRID
+        return [0] * (rows * cols)
+    values = []
+    for idx, row in enumerate(matrix):
+        values.extend(row if idx % 2 == 1 else reversed(row))
+    return [int(value * 100) for value in values]
+
+
+def comok_timeout(baudrate):
+    # 按应答长度计算传输时间，再加上屏幕的处理时间
+    return 0.1 + COMOK_SIZE * 10 / baudrate
+
+
+def load_screen_state(path=SCREEN_STATE_FILE):
+    try:
+        return json.loads(Path(path).expanduser().read_text())
+    except (OSError, ValueError):
+        return {}
+
+
+def save_screen_state(state, path=SCREEN_STATE_FILE):
+    path = Path(path).expanduser()
+    try:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(json.dumps(state))
+    except OSError as e:
+        logger.error(f'Save screen state failed: {e}')
+
+
+class ControlCache:
+    # 记录屏幕上各控件当前显示的值，按 (页面, 控件) 保存，用于跳过重复写入
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self.values = OrderedDict()
+
+    @staticmethod
+    def page_of(name):
+        # 'main.nozzletemp.txt' 属于 main 页面，不带页面前缀的控件归为 ''
+        page, sep, _ = name.partition('.')
+        return page if sep else ''
+
+    def changed(self, name, value):
+        key = (self.page_of(name), name)
+        if key in self.values and self.values[key] == value:
+            self.values.move_to_end(key)
+            return False
+        self.values[key] = value
+        self.values.move_to_end(key)
+        while len(self.values) > self.max_size:
+            self.values.popitem(last=False)
+        return True
+
+    def invalidate(self, page=None):
+        if page is None:
+            self.values.clear()
+            return
+        for key in [key for key in self.values if key[0] == page]:
+            del self.values[key]
+
 
 class ScreenMixin:
     debug = True
+    # 页面切换回调 on_page_changed(page)，page 为 None 表示所有控件都需要重新发送
+    on_page_changed = None
+
+    def __init__(self, state_file=SCREEN_STATE_FILE):
+        self.controls = ControlCache()
+        self.state_file = state_file
+        # connect 应答中的屏幕信息：型号、固件版本、序列号等
+        self.info = load_screen_state(state_file).get('info', {})
 
     def send_cmd(self, msg):
         data = bytearray()
         if isinstance(msg, str):
             if self.debug:
                 logger.debug(f'<send_cmd> {msg}')
+            if msg.startswith('page '):
+                self.page_changed(msg[5:].strip())
             data.extend(msg.encode('utf-8'))
         elif isinstance(msg, (bytes, bytearray)):
             data.extend(msg)
         else:
             logger.error(type(msg))
             raise Exception()
-        data.extend(bytes([0xff, 0xff, 0xff]))
+        data.extend(TERMINATOR)
         self.write(data)
 
+    def write_batch(self, commands):
+        # commands 为已编码、带结束符的命令，一次写入
+        self.write(b''.join(commands))
+
+    def page_changed(self, page):
+        # 切换页面后，该页面的控件恢复为默认值，不带页面前缀的控件也指向新页面
+        self.controls.invalidate(page)
+        self.controls.invalidate('')
+        if self.on_page_changed:
+            self.on_page_changed(page)
+
+    def repaint(self):
+        # 清空缓存，之后的 set_control_value 全部重新发送
+        self.controls.invalidate()
+        if self.on_page_changed:
+            self.on_page_changed(None)
+
     def sys_init(self, url, version):
         self.send_cmd(f'information.klipper_ver.txt="{version}"')
         self.send_cmd(f'information.url.txt="{url}"')
     
     def page_boot(self):
         logger.info('Page: boot')
+        # 屏幕可能已重启，缓存的控件值都不再可信
+        self.repaint()
         self.send_cmd('page boot')
         self.send_cmd('boot.tm_notify.en=1')
 
@@ -49,32 +153,18 @@ class ScreenMixin:
         logger.info('Page: main')
         self.send_cmd('page main')
     
-    @my_decorator
     def set_control_value(self, name, value):
+        # 返回是否发送，与屏幕上的值相同时不发送
+        if not self.controls.changed(name, value):
+            return False
         if isinstance(value, str):
             if name == 'main.nozzletemp.txt':
                 self.debug = False
             self.send_cmd(f'{name}="{value}"')
         else:
             self.send_cmd(f'{name}={value}')
+        return True
 
-    def global_update(self, **vals):
-        if 'extruder_temp' in vals:
-            text = f'{vals["extruder_temp"]:3.0f} / {vals["extruder_target_temp"]:0.0f}'
-            self.set_control_value('main.nozzletemp.txt', text)
-        if 'bed_temp' in vals:
-            text = f'{vals["bed_temp"]:3.0f} / {vals["bed_target_temp"]:0.0f}'
-            self.set_control_value('main.bedtemp.txt', text)
-        if 'led_state' in vals:
-            val = 0 if vals['led_state'] == 0 else 1
-            self.set_control_value('led_state', val)
-        if 'fan_speed' in vals:
-            val = int(vals['fan_speed'] * 100)
-            self.set_control_value('fan_speed', val)
-        if 'print_state' in vals:
-            val = 1 if vals['print_state'] == 'paused' else 0
-            self.set_control_value('paused', val)
-   
     def page_file(self, page, page_max, file_list, file_ext_list, path):
         self.send_cmd(f'file.page.val={page}')
         self.send_cmd(f'file.page_max.val={page_max}')
@@ -86,26 +176,19 @@ class ScreenMixin:
     async def page_ask_print(self, thumbnail):
         self.send_cmd('exp0.path=""')
         if thumbnail:
-            success = await asyncio.to_thread(self.upload_file_to_ram, thumbnail, 't.jpg')
+            success = await self.upload_file_to_ram(thumbnail, 't.jpg')
             if success:
                 self.send_cmd('exp0.path="ram/t.jpg"')
                 self.send_cmd('name.aph=0')
 
-    def page_printing_init(self, filename=None, thumbnail=None):
+    async def page_printing_init(self, filename=None, thumbnail=None):
         logger.info('Page: printpause')
         self.send_cmd('page printpause')
         if filename is not None:
             self.send_cmd(f'filename.txt="{Path(filename).stem}"')
         if thumbnail:
-            self.upload_file_to_ram(thumbnail, 't.jpg')
-            self.send_cmd('exp0.path="ram/t.jpg"')
-
-    def page_printing_update(self, progress, print_time, z, print_speed):
-        self.set_control_value('printpause.printprocess.val', int(progress*100))
-        self.set_control_value('printpause.printvalue.txt', str(int(progress*100)))
-        self.set_control_value('printpause.printtime.txt', print_time)
-        self.set_control_value('printpause.zvalue.val', int(z*100))
-        self.set_control_value('printpause.printspeed.txt', str(int(print_speed*100)))
+            if await self.upload_file_to_ram(thumbnail, 't.jpg'):
+                self.send_cmd('exp0.path="ram/t.jpg"')
 
     def page_finish(self, filename):
         self.send_cmd('page printfinish')
@@ -115,19 +198,14 @@ class ScreenMixin:
        self.send_cmd('page warn_rdlevel') 
 
     def page_leveling(self, matrix, offset):
-        logger.info('Page: leveling')
-        if not matrix or not matrix[0]:
-            matrix = [[0] * 6] * 6
-        index = 0
-        for idx, row in enumerate(matrix):
-            if idx % 2 == 1:
-                for col in row:
-                    self.send_cmd(f'x{index}.val={int(col*100)}')
-                    index += 1
-            else:
-                for col in row[::-1]:
-                    self.send_cmd(f'x{index}.val={int(col*100)}')
-                    index += 1
+        # 只发送与屏幕上当前值不同的点，切换页面后缓存失效会全部重新发送
+        # 命令中的 x0.val 不带页面前缀，缓存时按 leveling 页面的控件记录
+        changed = self.controls.changed
+        commands = [f'x{index}.val={value}'.encode() + TERMINATOR
+                    for index, value in enumerate(mesh_values(matrix)) if changed(f'leveling.x{index}.val', value)]
+        logger.info(f'Page: leveling, {len(commands)} points changed')
+        if commands:
+            self.write_batch(commands)
 
     def warning(self, enabled):
         if enabled:
@@ -137,173 +215,158 @@ class ScreenMixin:
         else:
             self.send_cmd('pwm7=0')
 
-    def create_thumbnail(self, filename, width, height, fillcolor=0):
-        import io
-        from PIL import Image
-        im = Image.open(filename)
-        im = im.rotate(270, expand=True)
-        w, h = im.size
-        if w != width or h != height:
-            scale_w = w / width
-            scale_h = h / height
-            if scale_w != scale_h:
-                if scale_w > scale_h:
-                    new_w = w
-                    new_h = int(height * scale_w)
-                    pos = (0, (new_h - h) // 2)
-                else:
-                    new_w = int(width * scale_h)
-                    new_h = h
-                    pos = ((new_w - w) // 2, 0)
-                new_im = Image.new('RGB', (new_w, new_h), fillcolor)
-                new_im.paste(im, pos)
-                im = new_im
-            im = im.resize((width, height))
-        fp = io.BytesIO()
-        im = im.convert('RGB')
-        im.save(fp, format='jpeg')
-        return fp.getvalue() 
-
-    def upload_file_to_ram(self, data, dst):
-        # clear screen state
-        self.ser.write(b'\x00\xff\xff\xff')
-        time.sleep(0.05)
-        self.ser.write(f'twfile "ram/{dst}",{len(data)}'.encode() + b'\xff\xff\xff')
-        val = self.ser.read(4)
-        if val[0] != 0xfe:
-            logger.error(f'twfile: status={val.hex(" ")}')
-            return False
-
-        header = bytearray.fromhex('3a a1 bb 44 7f ff fe')
-        chunk_no = 0
-        chunk_size = 4096
-        i = 0
-        while i < len(data):
-            wsize = chunk_size
-            if len(data) - i < chunk_size:
-                wsize = len(data) - i
-            info = struct.pack('<BHH', 0, chunk_no, wsize)
-            # logger.debug(f'[{n}] {i:5d}, {wsize:5d} / {len(data):5d}')
-            # logger.debug((header + info).hex(' '))
-            self.ser.write(header)
-            self.ser.write(info)
-            self.ser.write(data[i:i+wsize])
-            i += wsize
-            chunk_no += 1
-            val = self.ser.read(1)
-            if not val or (i != len(data) and val[0] != 0x05) or (i == len(data) and val[0] != 0xfd):
-                logger.error(f'ret: {val.hex(" ")}')
-                return False
-        self.ser.write(b'\x00\xff\xff\xff')
-        return True
-
-    def scan_device(self):
-        baudrate_list = (512000, 115200, 9600, 921600)
-        for baudrate in baudrate_list:
-            self.ser.apply_settings({'baudrate': baudrate, 'timeout': 0.4})
-            logger.debug(f'Connect screen with baudrate: {baudrate}')
-            self.ser.write(b'\x00\xff\xff\xff')
-            self.ser.write(b'\x00\xff\xff\xff')
-            time.sleep(0.1)
-            self.ser.write(b'connect\xff\xff\xff')
-            data = self.ser.read(100)
-            if data:
-                logger.debug(data)
-                if b'comok' in data:
-                    logger.debug('Connected.')
-                    return True
-        logger.error('Connect screen failed!')
+    def baudrate_list(self):
+        # 上次连接成功的波特率优先
+        last = load_screen_state(self.state_file).get('baudrate')
+        return ((last,) if last else ()) + tuple(baudrate for baudrate in BAUDRATE_LIST if baudrate != last)
 
-    def download_firmware(self, firmware, auto_connect=True):
-        if auto_connect:
-            if not self.scan_device():
-                return False
-        with open(firmware, 'rb') as fp:
-            content = fp.read()
-        logger.info('Begin update screen firmware...')
-        # 让屏幕进入卡顿2.5秒,防止现有工程不断发送数据干扰下载
-        self.ser.write(b'delay=2500\xff\xff\xff')
-        self.ser.write(b'0\xff\xff\xff')
-        # 1.5秒后发下载指令
-        DOWNLOAD_BAUDRATE = 921600
-        # DOWNLOAD_BAUDRATE = 9600
-        time.sleep(1.5)
-        logger.debug(f'Switch baudrate to {DOWNLOAD_BAUDRATE}')
-        logger.debug(f'whmi-wri {len(content)},{DOWNLOAD_BAUDRATE},0')
-        self.ser.write(f'whmi-wri {len(content)},{DOWNLOAD_BAUDRATE},0'.encode() + b'\xff\xff\xff')
-        # 等待发送完毕，再修改波特率
-        time.sleep(0.2)
-        # 屏幕收到修改波特率命令后270ms后回复0x05，timeout设的久一点
-        self.ser.apply_settings({'baudrate': DOWNLOAD_BAUDRATE, 'timeout': 0.5})
-        self.ser.reset_input_buffer()
-        status = self.ser.read()
-        logger.debug(f'Status: {status}')
-        if status and status[0] == 0x05:
-            CHUNK_SIZE = 4096
-            i = 0
-            while i < len(content):
-                chunk = content[i : i + CHUNK_SIZE]
-                self.ser.write(chunk)
-                status = self.ser.read()
-                if not status or status[0] != 0x05:
-                    return False
-                i += len(chunk)
-        return True
+    def screen_connected(self, baudrate, data):
+        logger.debug(data)
+        self.info = parse_comok(data) or {}
+        logger.info(f'Connected: {baudrate} {self.info.get("model")} firmware={self.info.get("firmware")}')
+        save_screen_state({'baudrate': baudrate, 'info': self.info}, self.state_file)
 
     def set_fan(self, enable):
-        self.ser.rts = True if enable else False
-
+        # 串口未打开时忽略，重新打开后由调用方恢复风扇状态
+        if self.ser is None:
+            return
+        try:
+            self.ser.rts = True if enable else False
+        except OSError as e:
+            logger.error(f'Set fan failed: {e!r}')
 
-class TJC(ScreenMixin):
-    def __init__(self, port):
-        self.ser = serial.Serial(port, 115200, timeout=0.5)
-
-    def write(self, msg):
-        self.ser.write(msg)
-    
-    def close(self):
-        self.ser.close()
-    
-    def get_version(self):
-        self.ser.reset_input_buffer()
-        self.page_boot()
-        self.ser.apply_settings({'timeout': 1.5})
-        data = self.ser.read(30)
-        logger.debug(data)
-        if data:
-            pos = data.find(b'boot version=')
-            if pos == -1:
-                return None
-            data = data[pos:].decode().split('=')[-1]
-            return int(data)
-    
 
 class AsyncSerialScreenProtocol(asyncio.Protocol):
     on_request = None
+    # 发送缓冲区超过高水位/降到低水位时回调 on_writing_paused(True/False)
+    on_writing_paused = None
+    # capture.CaptureWriter，记录收到的串口数据
+    capture = None
+    # 串口断开（拔出、关闭）时回调 on_connection_lost(exc)
+    on_connection_lost = None
+    HEADER = b'\x5a\xa5'
+    # 已处理的数据超过该长度才整理缓冲区
+    COMPACT_SIZE = 1024
+    MAX_BUFFER_SIZE = 4096
 
     def connection_made(self, transport):
         self.transport = transport
         self.recv_data = bytearray()
+        self.offset = 0
+        self.decode_errors = 0
+        self.dropped_bytes = 0
+        # 文件传输期间收到的数据（应答）不经过分包，直接交给 read_raw
+        self.raw_data = None
+        self.raw_size = 0
+        self.raw_waiter = None
 
     def data_received(self, data):
-        self.recv_data.extend(data)
-        while len(self.recv_data) >= 3:
-            if self.recv_data[0] != 0x5a or self.recv_data[1] != 0xa5:
-                logger.debug(f'{self.recv_data[0]:02x}')
-                self.recv_data.pop(0)
-                continue
-            packet_size = self.recv_data[2]
-            if len(self.recv_data) < 3 + packet_size:
+        if self.capture is not None:
+            self.capture.record(SERIAL_RX, bytes(data))
+        if self.raw_data is not None:
+            self.raw_data.extend(data)
+            if self.raw_waiter and not self.raw_waiter.done() and len(self.raw_data) >= self.raw_size:
+                self.raw_waiter.set_result(None)
+            return
+        buf = self.recv_data
+        buf.extend(data)
+        while True:
+            start = buf.find(self.HEADER, self.offset)
+            if start == -1:
+                # 没有包头，丢弃数据，末尾的 0x5a 可能是下一个包头的一部分
+                end = len(buf) - 1 if buf.endswith(self.HEADER[:1]) else len(buf)
+                self.drop(end)
                 break
-            packet = self.recv_data[0:3+packet_size]
+            self.drop(start)
+            if len(buf) < start + 3:
+                break
+            end = start + 3 + buf[start + 2]
+            if len(buf) < end:
+                break
+            self.offset = end
+            with memoryview(buf) as view, view[start + 3:end] as packet:
+                try:
+                    request = str(packet, 'utf-8')
+                except UnicodeDecodeError:
+                    self.decode_errors += 1
+                    logger.error(f'Invalid packet: {packet.hex(" ")}')
+                    continue
+            if self.on_request:
+                try:
+                    self.on_request(request)
+                except Exception as e:
+                    logger.error(f'Request handler failed: {e!r}')
+        if len(buf) - self.offset > self.MAX_BUFFER_SIZE:
+            logger.error(f'Receive buffer overflow, drop {len(buf) - self.offset} bytes')
+            self.drop(len(buf))
+        if self.offset == len(buf):
+            buf.clear()
+            self.offset = 0
+        elif self.offset >= self.COMPACT_SIZE:
+            del buf[:self.offset]
+            self.offset = 0
+
+    def drop(self, end):
+        if end > self.offset:
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug(f'Drop {end - self.offset} bytes: {self.recv_data[self.offset:min(end, self.offset + 16)].hex(" ")}')
+            self.dropped_bytes += end - self.offset
+            self.offset = end
+
+    def start_raw(self):
+        self.raw_data = bytearray()
+
+    def end_raw(self):
+        self.raw_data = None
+
+    async def read_raw(self, size, timeout):
+        # 与 serial.read 类似，超时后返回已收到的数据（可能不足 size）
+        if len(self.raw_data) < size:
+            self.raw_size = size
+            self.raw_waiter = asyncio.get_running_loop().create_future()
             try:
-                if self.on_request:
-                    data = packet[3:]
-                    asyncio.create_task(self.on_request(data.decode('utf-8')))
-                self.recv_data = self.recv_data[len(packet):]
-            except Exception as e:
-                logger.error(e)
-                self.recv_data.clear()
+                await asyncio.wait_for(self.raw_waiter, timeout)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self.raw_waiter = None
+        data = bytes(self.raw_data[:size])
+        del self.raw_data[:size]
+        return data
+
+    async def read_raw_until(self, terminator, timeout):
+        # 读取直到收到 terminator 或超时，返回收到的全部数据
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while terminator not in self.raw_data:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            self.raw_size = len(self.raw_data) + 1
+            self.raw_waiter = loop.create_future()
+            try:
+                await asyncio.wait_for(self.raw_waiter, remaining)
+            except asyncio.TimeoutError:
+                pass
+            finally:
+                self.raw_waiter = None
+        data = bytes(self.raw_data)
+        self.raw_data.clear()
+        return data
+
+    def connection_lost(self, exc):
+        if self.raw_waiter is not None and not self.raw_waiter.done():
+            self.raw_waiter.set_result(None)
+        if self.on_connection_lost is not None:
+            self.on_connection_lost(exc)
+
+    def pause_writing(self):
+        if self.on_writing_paused is not None:
+            self.on_writing_paused(True)
+
+    def resume_writing(self):
+        if self.on_writing_paused is not None:
+            self.on_writing_paused(False)
 
     def pause_reading(self):
         # This will stop the callbacks to data_received
@@ -313,57 +376,427 @@ class AsyncSerialScreenProtocol(asyncio.Protocol):
         # This will start the callbacks to data_received again with all data that has been received in the meantime.
         self.transport.resume_reading()
 
-class AsyncTJCScreen(ScreenMixin):
+class CommandQueue:
+    # 收集同一帧内发送的命令，合并为一次写入
+    # 每次写入串口后回调 on_flush()
+    on_flush = None
+    # 队列超过上限、丢弃了最旧的命令后回调 on_overflow()，屏幕上的值已经不确定
+    on_overflow = None
+
+    def __init__(self, write, interval=0, max_size=8192):
+        self._write = write
+        self.interval = interval
+        self.max_size = max_size
+        self.pending = []
+        self.size = 0
+        # 当前分段内 控件名 -> pending 中的位置，同一控件只保留最后一次赋值
+        self.keys = {}
+        self.handle = None
+        # 文件传输期间暂停发送，命令继续在队列中合并
+        self.holding = False
+        # 串口发送缓冲区超过高水位，等降到低水位再发送
+        self.blocked = False
+        self.commands = 0
+        self.bytes = 0
+        self.flushes = 0
+        self.merged = 0
+        self.dropped = 0
+        self.overflows = 0
+        self.overflowing = False
+        self._last_stats = (time.monotonic(), 0, 0, 0)
+
+    @staticmethod
+    def control_key(data):
+        # 'name=value' 形式的赋值命令返回 name，其他命令返回 None
+        pos = data.find(b'=')
+        if pos <= 0:
+            return None
+        key = bytes(data[:pos])
+        if b' ' in key or b'"' in key:
+            return None
+        return key
+
+    def put(self, data):
+        self.commands += 1
+        key = self.control_key(data)
+        if key is None:
+            # 非赋值命令（page、click 等）作为分段边界，保证前后顺序不变
+            self.keys.clear()
+            self.pending.append(data)
+        elif key in self.keys:
+            index = self.keys[key]
+            self.size -= len(self.pending[index])
+            self.pending[index] = data
+            self.merged += 1
+        else:
+            self.keys[key] = len(self.pending)
+            self.pending.append(data)
+        self.size += len(data)
+        if self.size > self.max_size:
+            self.compact()
+        if self.handle is None and not self.paused:
+            loop = asyncio.get_running_loop()
+            if self.interval > 0:
+                self.handle = loop.call_later(self.interval, self.flush)
+            else:
+                self.handle = loop.call_soon(self.flush)
+
+    @staticmethod
+    def droppable(key):
+        # 'page.control.attr' 形式的控件不受当前页面影响，发送受阻时只需要最新的值
+        return key is not None and key.count(b'.') >= 2
+
+    def compact(self):
+        # 队列不超过 max_size：先跨分段丢弃被后面覆盖的 'page.control.attr' 赋值，page 等命令和其他赋值保持原有顺序；
+        # 仍然超过时所有控件赋值只保留最后一次，最后丢弃最旧的命令
+        self._merge(self.droppable)
+        if self.size > self.max_size:
+            self.overflows += 1
+            self._merge(lambda key: key is not None)
+        if self.size > self.max_size:
+            size = self.size
+            cut = 0
+            while size > self.max_size:
+                size -= len(self.pending[cut])
+                cut += 1
+            if not self.overflowing:
+                # 发送恢复之前只记录一次
+                self.overflowing = True
+                logger.warning(f'Command queue overflow: {len(self.pending)} commands, {self.size} bytes, dropping oldest')
+            del self.pending[:cut]
+            self.dropped += cut
+            self.size = size
+            if self.on_overflow is not None:
+                self.on_overflow()
+        self.keys.clear()
+        for index in range(len(self.pending) - 1, -1, -1):
+            key = self.control_key(self.pending[index])
+            if key is None:
+                break
+            self.keys.setdefault(key, index)
+
+    def _merge(self, mergeable):
+        seen = set()
+        result = []
+        for data in reversed(self.pending):
+            key = self.control_key(data)
+            if mergeable(key):
+                if key in seen:
+                    self.dropped += 1
+                    continue
+                seen.add(key)
+            result.append(data)
+        result.reverse()
+        self.pending = result
+        self.size = sum(len(data) for data in result)
+
+    @property
+    def paused(self):
+        return self.holding or self.blocked
+
+    def set_blocked(self, blocked):
+        self.blocked = blocked
+        if not blocked:
+            self.flush()
+
+    def flush(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        if not self.pending or self.paused:
+            return
+        data = b''.join(self.pending)
+        self.overflowing = False
+        self.pending.clear()
+        self.keys.clear()
+        self.size = 0
+        self.bytes += len(data)
+        self.flushes += 1
+        self._write(data)
+        if self.on_flush is not None:
+            self.on_flush()
+
+    def hold(self):
+        self.flush()
+        self.holding = True
+
+    def release(self):
+        self.holding = False
+        self.flush()
+
+    def clear(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        self.pending.clear()
+        self.keys.clear()
+        self.size = 0
+
+    def stats(self):
+        # 返回累计值以及距上次调用以来的每秒速率
+        now = time.monotonic()
+        last_time, last_commands, last_bytes, last_flushes = self._last_stats
+        elapsed = max(now - last_time, 1e-6)
+        self._last_stats = (now, self.commands, self.bytes, self.flushes)
+        return {
+            'commands': self.commands,
+            'bytes': self.bytes,
+            'flushes': self.flushes,
+            'merged': self.merged,
+            'dropped': self.dropped,
+            'overflows': self.overflows,
+            'pending': len(self.pending),
+            'pending_bytes': self.size,
+            'blocked': self.blocked,
+            'commands_per_sec': (self.commands - last_commands) / elapsed,
+            'bytes_per_sec': (self.bytes - last_bytes) / elapsed,
+            'flushes_per_sec': (self.flushes - last_flushes) / elapsed,
+        }
+
 
-    def __init__(self):
+class AsyncTJCScreen(ScreenMixin):
+    ACK_TIMEOUT = 5
+    # metrics.Metrics，记录缩略图上传时间
+    metrics = None
+    # capture.CaptureWriter，记录发送的串口数据（不包括固件）
+    capture = None
+    DOWNLOAD_BAUDRATE = 921600
+    FIRMWARE_CHUNK_SIZE = 4096
+    # 串口发送缓冲区的高低水位，512000 波特率下 2KB 约需 40ms 发送完
+    WRITE_BUFFER_HIGH = 2048
+    WRITE_BUFFER_LOW = 512
+
+    def __init__(self, frame_interval=0, state_file=SCREEN_STATE_FILE):
+        super().__init__(state_file)
         self.transport = None
         self.protocol = None
         self.ser = None
+        self.queue = CommandQueue(self._transport_write, frame_interval)
+        # 丢弃的命令可能已经记录在控件缓存中，之后全部重新发送
+        self.queue.on_overflow = self.repaint
+        # 串口打开之前命令留在队列中
+        self.queue.set_blocked(True)
+        self.raw_lock = asyncio.Lock()
+        self.closed = None
 
     async def start(self, port, baudrate=115200):
-        self.transport, self.protocol = await serial_asyncio.create_serial_connection(asyncio.get_event_loop(), AsyncSerialScreenProtocol, port, baudrate=baudrate)
+        import serial_asyncio
+        transport, protocol = await serial_asyncio.create_serial_connection(asyncio.get_event_loop(), AsyncSerialScreenProtocol, port, baudrate=baudrate)
+        self.attach(transport, protocol)
+
+    def attach(self, transport, protocol):
+        self.transport, self.protocol = transport, protocol
         self.ser = self.transport.serial
+        self.transport.set_write_buffer_limits(self.WRITE_BUFFER_HIGH, self.WRITE_BUFFER_LOW)
+        self.protocol.on_writing_paused = self.queue.set_blocked
+        self.protocol.on_connection_lost = self._connection_lost
+        self.protocol.capture = self.capture
+        self.closed = asyncio.get_running_loop().create_future()
+        self.queue.set_blocked(False)
+
+    def _connection_lost(self, exc):
+        if exc is not None:
+            logger.error(f'Serial disconnected: {exc!r}')
+        self.transport = None
+        self.ser = None
+        # 断开期间的命令不再发送，重新打开后屏幕会重新开机并刷新全部控件
+        self.queue.clear()
+        self.queue.set_blocked(True)
+        if not self.closed.done():
+            self.closed.set_result(exc)
+
+    async def wait_closed(self):
+        await self.closed
+
+    def close(self):
+        if self.transport is not None:
+            self.flush()
+            self.transport.close()
 
     def set_request_handler(self, handler):
         self.protocol.on_request = handler
 
     def write(self, data):
+        self.queue.put(data)
+
+    def write_batch(self, commands):
+        # 逐条放入队列，同一帧内合并为一次串口写入
+        for data in commands:
+            self.queue.put(data)
+
+    def flush(self):
+        self.queue.flush()
+
+    def _transport_write(self, data):
+        if self.capture is not None:
+            self.capture.record(SERIAL_TX, bytes(data))
         self.transport.write(data)
 
-    def test(self, transport:serial_asyncio.SerialTransport):
+    def stats(self):
+        stats = self.queue.stats()
+        stats['write_buffer'] = self.transport.get_write_buffer_size() if self.transport else 0
+        return stats
+
+    def test(self, transport):
         transport.pause_reading
 
-    def start_raw_serial(self):
-        # stop reading & set timeout=0
-        self.settings = self.ser.get_settings()
-        self.transport.pause_reading()
-        self.ser.reset_input_buffer()
-        self.ser.apply_settings({'timeout': 100})
-    
-    def end_raw_serial(self):
-        # restore settings & read
-        self.ser.reset_input_buffer()
-        self.transport.resume_reading()
-        self.ser.apply_settings(self.settings)
+    async def raw_session(self, func, *args):
+        # 独占串口进行文件传输，期间普通命令留在队列中合并，结束后恢复波特率
+        async with self.raw_lock:
+            # 串口断开期间不传输，传输中断开时 ser 和 protocol 都可能已被替换或清空
+            if self.transport is None:
+                return False
+            ser, protocol = self.ser, self.protocol
+            baudrate = None
+            try:
+                self.queue.hold()
+                protocol.start_raw()
+                baudrate = ser.baudrate
+                return await func(*args)
+            except Exception as e:
+                logger.error(f'{func.__name__}: {e!r}')
+                return False
+            finally:
+                if self.ser is ser and baudrate is not None and ser.baudrate != baudrate:
+                    ser.baudrate = baudrate
+                protocol.end_raw()
+                self.queue.release()
+
+    async def drain(self):
+        while self.transport.get_write_buffer_size():
+            await asyncio.sleep(0.01)
+
+    async def upload_file_to_ram(self, data, dst):
+        # 传输一旦开始就不能中断，否则屏幕会把后续命令当作文件数据
+        start = time.monotonic()
+        result = await asyncio.shield(self.raw_session(self._upload_file_to_ram, data, dst))
+        if self.metrics is not None:
+            self.metrics.observe('thumbnail.upload', start)
+        return result
+
+    async def _upload_file_to_ram(self, data, dst):
+        write = self._transport_write
+        # clear screen state
+        write(b'\x00\xff\xff\xff')
+        await asyncio.sleep(0.05)
+        self.protocol.raw_data.clear()
+        write(f'twfile "ram/{dst}",{len(data)}'.encode() + b'\xff\xff\xff')
+        val = await self.protocol.read_raw(4, self.ACK_TIMEOUT)
+        if not val or val[0] != 0xfe:
+            logger.error(f'twfile: status={val.hex(" ")}')
+            return False
 
-    def upload_file_to_ram(self, data, dst):
-        logger.debug('Switch serial to sync mode.')
-        self.start_raw_serial()
-        try:
-            return super().upload_file_to_ram(data, dst)
-        except:
-            pass
-        finally:
-            logger.debug('Switch serial back to async mode.')
-            self.end_raw_serial()
-
-    def download_firmware(self, firmware):
-        logger.debug('Switch serial to sync mode.')
-        self.start_raw_serial()
-        try:
-            return super().download_firmware(firmware)
-        except:
-            pass
-        finally:
-            logger.debug('Switch serial back to async mode.')
-            self.end_raw_serial()
+        header = bytes.fromhex('3a a1 bb 44 7f ff fe')
+        chunk_size = 4096
+        view = memoryview(data)
+        for chunk_no, i in enumerate(range(0, len(data), chunk_size)):
+            chunk = view[i:i+chunk_size]
+            write(header + struct.pack('<BHH', 0, chunk_no, len(chunk)))
+            write(chunk)
+            expected = 0xfd if i + len(chunk) == len(data) else 0x05
+            val = await self.protocol.read_raw(1, self.ACK_TIMEOUT)
+            if not val or val[0] != expected:
+                logger.error(f'ret: {val.hex(" ")}')
+                return False
+        write(b'\x00\xff\xff\xff')
+        return True
+
+    async def scan_device(self):
+        # 需要在 raw_session 中调用
+        for baudrate in self.baudrate_list():
+            self.ser.baudrate = baudrate
+            logger.debug(f'Connect screen with baudrate: {baudrate}')
+            self.transport.write(b'\x00\xff\xff\xff')
+            self.transport.write(b'\x00\xff\xff\xff')
+            await asyncio.sleep(0.1)
+            self.protocol.raw_data.clear()
+            self.transport.write(b'connect\xff\xff\xff')
+            data = await self.protocol.read_raw_until(b'\xff\xff\xff', comok_timeout(baudrate))
+            if b'comok' in data:
+                self.screen_connected(baudrate, data)
+                return True
+        logger.error('Connect screen failed!')
+        return False
+
+    async def download_firmware(self, firmware, resume=False, retries=3):
+        # resume=True 时使用 whmi-wris，重试时屏幕会通过 0x08 应答告知从哪里继续
+        for attempt in range(retries + 1):
+            if attempt:
+                delay = 2 ** attempt
+                logger.info(f'Retry firmware update in {delay}s ({attempt}/{retries})')
+                await asyncio.sleep(delay)
+            if await asyncio.shield(self.raw_session(self._download_firmware, firmware, resume)):
+                return True
+        return False
+
+    async def _firmware_ack(self):
+        # 应答超时后逐步延长等待时间，屏幕写 flash 时偶尔会回复得比较慢
+        status = b''
+        for timeout in (0.5, 1, 2):
+            status = await self.protocol.read_raw(1, timeout)
+            if status:
+                break
+        if not status:
+            logger.error('Firmware: no ack')
+            return None
+        if status[0] == 0x08:
+            status += await self.protocol.read_raw(4, 1)
+            if len(status) != 5:
+                return None
+        elif status[0] != 0x05:
+            logger.error(f'Firmware: ack={status.hex(" ")}')
+            return None
+        return status
+
+    async def _download_firmware(self, firmware, resume):
+        if not await self.scan_device():
+            return False
+        size = os.path.getsize(firmware)
+        write = self.transport.write
+        logger.info('Begin update screen firmware...')
+        # 让屏幕进入卡顿2.5秒,防止现有工程不断发送数据干扰下载
+        write(b'delay=2500\xff\xff\xff')
+        write(b'0\xff\xff\xff')
+        # 1.5秒后发下载指令
+        await asyncio.sleep(1.5)
+        command = 'whmi-wris' if resume else 'whmi-wri'
+        logger.debug(f'{command} {size},{self.DOWNLOAD_BAUDRATE},0')
+        write(f'{command} {size},{self.DOWNLOAD_BAUDRATE},0'.encode() + b'\xff\xff\xff')
+        # 等待发送完毕，再修改波特率
+        await self.drain()
+        await asyncio.sleep(0.2)
+        # 屏幕收到修改波特率命令后270ms后回复0x05，timeout设的久一点
+        logger.debug(f'Switch baudrate to {self.DOWNLOAD_BAUDRATE}')
+        self.ser.baudrate = self.DOWNLOAD_BAUDRATE
+        self.protocol.raw_data.clear()
+        status = await self.protocol.read_raw(1, 0.5)
+        logger.debug(f'Status: {status}')
+        if not status or status[0] != 0x05:
+            return False
+
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        offset = 0
+        report = 0
+        with open(firmware, 'rb') as fp:
+            chunk = await loop.run_in_executor(None, fp.read, self.FIRMWARE_CHUNK_SIZE)
+            while chunk:
+                write(chunk)
+                offset += len(chunk)
+                # 等待应答的同时读取下一块
+                pending = loop.run_in_executor(None, fp.read, self.FIRMWARE_CHUNK_SIZE)
+                status = await self._firmware_ack()
+                chunk = await pending
+                if status is None:
+                    return False
+                if status[0] == 0x08:
+                    # 屏幕已有部分数据，从指定位置继续
+                    offset = struct.unpack('<I', status[1:5])[0]
+                    logger.info(f'Firmware: resume from {offset}')
+                    fp.seek(offset)
+                    chunk = await loop.run_in_executor(None, fp.read, self.FIRMWARE_CHUNK_SIZE)
+                if offset * 10 // size > report or not chunk:
+                    report = offset * 10 // size
+                    elapsed = time.monotonic() - start
+                    logger.info(f'Firmware: {offset}/{size} ({offset * 100 // size}%), {offset / max(elapsed, 1e-3):.0f} bytes/s')
+        return True